@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+"""This script compiles all template files in the template directory and
+writes their compiled files, so that the first requests after deploying do
+not compile templates. Malformed templates are reported with their line
+numbers, and the script exits with status 1 if there are any."""
+
+
+import argparse
+import os
+import sys
+
+from ng import _template_loader
+from ng.excepts import NGError
+import config
+
+
+def _template_filepaths(template_dir):
+    """Return sorted paths to all template files in the directory. Hidden
+    files and directories are skipped."""
+    filepaths = []
+    for dirpath, dirnames, filenames in os.walk(template_dir):
+        dirnames[:] = [name for name in dirnames if not name.startswith('.')]
+        filepaths.extend(os.path.join(dirpath, name) for name in filenames
+                         if not name.startswith('.'))
+
+    return sorted(filepaths)
+
+
+def compile_templates(template_dir):
+    """Compile all template files in the directory. Return tuple (number of
+    compiled templates, number of malformed templates)."""
+    compiled = 0
+    failed = 0
+
+    for filepath in _template_filepaths(template_dir):
+        # Errors of malformed templates tell their line numbers
+        try:
+            written = _template_loader.compile_template(filepath)
+        except NGError as e:
+            sys.stderr.write('%s: %s\n' % (filepath, e))
+            failed += 1
+            continue
+
+        if not written:
+            sys.stderr.write('Warning: compiled file of %s is not written\n'
+                             % filepath)
+        compiled += 1
+
+    return compiled, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compile and check all template files.')
+    parser.add_argument('-d', '--template-dir',
+                        default=config.SITE_CONF.get('template_path', ''),
+                        help='directory of the template files')
+    args = parser.parse_args()
+
+    compiled, failed = compile_templates(args.template_dir)
+    print 'Compiled %d templates, %d templates are malformed.' % \
+        (compiled, failed)
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
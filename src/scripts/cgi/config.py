@@ -4,6 +4,7 @@ stored in the package global variable SITE_CONF."""
 
 
 import os
+import posixpath
 from ng.excepts import HttpError
 
 
@@ -59,6 +60,20 @@ def storage_filepath(storage_filename):
                         storage_filename)
 
 
+def avatar_filename(avatar_name):
+    """Return the name of an avatar file in storage. Files are placed in
+    sub-directories named after the leading characters of avatar_name, such
+    as 'avatars/ab/cd/abcdef.png', so that no directory holds too many
+    files."""
+    layout = SITE_CONF.get('avatar_storage_layout') or {}
+    levels = layout.get('fanout_levels', 0)
+    width = layout.get('fanout_width', 2)
+
+    sub_dirs = [avatar_name[(i * width):((i + 1) * width)].lower()
+                for i in range(levels)]
+    return posixpath.join('avatars', *(sub_dirs + [avatar_name]))
+
+
 # Get absolute path for configuration file
 _conf_relative_filepath = '../conf/ngavatar.conf'
 _current_path = os.path.dirname(os.path.realpath(__file__))
@@ -0,0 +1,57 @@
+"""This module dispatches HTTP requests to handler functions. It is shared
+by the CGI gateway script and the WSGI application."""
+
+
+from ng.excepts import HttpError
+import handlers
+from handlers import _errorhelper
+import config
+
+
+def _compress_response(response, request):
+    """Let the response be compressed for the client of the request with
+    the compression settings in the configuration."""
+    compression_conf = config.SITE_CONF.get('compression')
+    if compression_conf and request is not None:
+        response.compress(request.accept_encoding,
+                          compression_conf.get('encodings', ('gzip',)),
+                          compression_conf.get('min_bytes', 1024),
+                          compression_conf.get('level', 6))
+
+    return response
+
+
+def response_from_error(error, request=None):
+    """Get HttpErrorResponse object from HttpError object. The response is
+    compressed for the client of request if it is given."""
+    # Get error response with the error page
+    response = _errorhelper.http_error_response(error.error_code, request,
+                                                config.SITE_CONF)
+    response.add_headers(error.extra_headers)
+
+    return _compress_response(response, request)
+
+
+def upload_options():
+    """Return keyword arguments of parsing request bodies with the limits in
+    the configuration."""
+    upload_conf = config.SITE_CONF.get('upload') or {}
+    return dict(
+        upload_dir=config.storage_filepath(upload_conf.get('temp_dir',
+                                                           'tmp')),
+        max_body_bytes=upload_conf.get('max_body_bytes')
+    )
+
+
+def response_for_request(request):
+    """Call the handler for the request and return the HttpResponse object
+    it generates. HttpError is raised if no response is generated."""
+    # Get handler for the request
+    handler = handlers.handler_for_script(request.script_name)
+
+    # Call handler to generate response
+    response = handler(request, config.SITE_CONF)
+    if response is None:
+        raise HttpError(500)
+
+    return _compress_response(response, request)
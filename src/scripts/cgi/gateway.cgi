@@ -1,30 +1,26 @@
 #!/usr/bin/env python
 
 
-import cgi
 import cgitb
 import os
-from ng.http import HttpRequest
-from ng.http import HttpErrorResponse
+import sys
+import traceback
+from ng.http import HttpRequest, parse_form_fields
 from ng.excepts import HttpError
-from ng.views import StaticView
-import handlers
 import config
+import dispatch
 
 
-def response_from_error(error):
-    """Get HttpErrorResponse object from HttpError object."""
-    # Get error view
-    error_page_path = config.static_filepath(
-        config.SITE_CONF['error_pages'].get(error.error_code)
-    )
-    error_view = StaticView(error_page_path)
+def abort_response(response):
+    """Log the error raised while writing a response and return True if its
+    headers have been written. Errors of streamed bodies happen after that,
+    and another response can't be written in the middle of the body."""
+    if response is None or not response.headers_sent:
+        return False
 
-    # Get error response
-    response = HttpErrorResponse(error.error_code, error_view)
-    response.add_headers(error.extra_headers)
-
-    return response
+    sys.stderr.write('Response aborted after headers were sent:\n%s' %
+                     traceback.format_exc())
+    return True
 
 
 def main():
@@ -35,34 +31,42 @@ def main():
     if traceback_enabled:
         cgitb.enable()
 
+    request = None
+    response = None
     try:
         # Create request from envirioment variables and field storage
-        request = HttpRequest(os.environ, cgi.FieldStorage())
-
-        # Get handler for the request
-        handler = handlers.handler_for_script(request.script_name)
+        field_storage = parse_form_fields(sys.stdin, os.environ,
+                                          **dispatch.upload_options())
+        request = HttpRequest(os.environ, field_storage)
 
         # Call handler to generate response and write the response
-        response = handler(request, config.SITE_CONF)
-        if response is not None:
-            response.write_to_output()
-        else:
-            raise HttpError(500)
+        response = dispatch.response_for_request(request)
+        response.write_to_output()
     except HttpError as e:
+        if abort_response(response):
+            return
+
         # Raise 500 error if traceback enabled
         if traceback_enabled and e.error_code == 500:
             raise e
         else:
-            response = response_from_error(e)
+            response = dispatch.response_from_error(e, request)
             response.write_to_output()
     except Exception as e:
+        if abort_response(response):
+            return
+
         # Raise unrecognized error if traceback enabled
         if traceback_enabled:
             raise e
         else:
             http_error = HttpError(500)
-            response = response_from_error(http_error)
+            response = dispatch.response_from_error(http_error, request)
             response.write_to_output()
+    finally:
+        # Remove uploaded files that are not used
+        if request is not None:
+            request.close()
 
 
 if __name__ == '__main__':
@@ -1,6 +1,7 @@
 """This package defines HTTP request handler functions."""
 
 
+from ng.database import DatabaseAccessError
 from ng.excepts import HttpError
 import _index
 import _signup
@@ -17,8 +18,10 @@ import _avatar
 import _setavatar
 import _setavatar_action
 import _avatar_api
+import _avatar_file
 import _deleteemail
 import _deleteavatar
+import _avatarhelper
 
 
 # Handlers table
@@ -38,6 +41,7 @@ _handlers = {
     '/user/setavatar': _setavatar.handler,
     '/user/setavatar_action': _setavatar_action.handler,
     '/avatar': _avatar_api.handler,
+    '/avatar/file': _avatar_file.handler,
     '/user/deleteemail': _deleteemail.handler,
     '/user/deleteavatar': _deleteavatar.handler,
 }
@@ -49,3 +53,13 @@ def handler_for_script(script_name):
         return _handlers[script_name]
     else:
         raise HttpError(404)
+
+
+def preload(conf):
+    """Load data that handlers keep in memory. Long-lived servers call it at
+    startup, so that the data is shared by all requests."""
+    try:
+        _avatarhelper.preload(conf)
+    except DatabaseAccessError:
+        # The data will be loaded by the first request that needs it
+        pass
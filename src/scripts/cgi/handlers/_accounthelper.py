@@ -16,11 +16,12 @@ class InvalidSessionException(Exception):
         self.response = response
 
 
-def get_session_account(request, db):
+def get_session_account(request, db, conf):
     """Try to extract account signed in from the request. Return Account
     object if successful. Raise InvalidSessionException if failed."""
-    # Get session from database
-    session = _sessionhelper.get_session(request, db)
+    # Get session with its account from database
+    session, account = _sessionhelper.get_session_with_account(request, db,
+                                                               conf)
 
     # Redirect request to sign in page if session doesn't exist
     if session is None:
@@ -40,8 +41,12 @@ def get_session_account(request, db):
         response.set_cookie(cookie)
         raise InvalidSessionException(response)
 
+    # Sessions created before they were linked to accounts need another
+    # query
+    if account is None:
+        account = Account.load_from_database(db, uid=uid)
+
     # Redirect request to sign in page and expire cookie if uid is invalid
-    account = Account.load_from_database(db, uid=uid)
     if account is None:
         session.invalidate()
         cookie = _sessionhelper.expire_cookie_for_session(
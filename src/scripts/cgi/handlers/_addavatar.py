@@ -2,11 +2,11 @@
 
 
 from ng import httpfilters
-from ng.database import MySQLDatabase
 from ng.http import HttpResponse, HttpRedirectResponse
 from ng.views import TemplateView
 import config
 import _accounthelper
+import _databasehelper
 
 
 def addavatar_response(account, conf):
@@ -27,10 +27,10 @@ def addavatar_response(account, conf):
 @httpfilters.allow_methods('GET')
 def handler(request, conf):
     """The handler function."""
-    with MySQLDatabase(conf.get('database_connection')) as db:
+    with _databasehelper.open_database(conf) as db:
         # Try to get signed account
         try:
-            account = _accounthelper.get_session_account(request, db)
+            account = _accounthelper.get_session_account(request, db, conf)
         except _accounthelper.InvalidSessionException as e:
             return e.response
 
@@ -1,16 +1,17 @@
 """This module defines handler that handles add avatar action requests."""
 
 
+import errno
 import os
 from ng import httpfilters
-from ng import str_generator
-from ng.database import MySQLDatabase
 from ng.excepts import FileWriteError
 from ng.http import HttpResponse, HttpRedirectResponse
-from ng.models import Avatar
+from ng.models import Avatar, AvatarBlob
 from ng.views import TemplateView
 import config
 import _accounthelper
+import _databasehelper
+import _jobhelper
 
 
 def failed_response(account, error_message, conf):
@@ -29,6 +30,24 @@ def failed_response(account, error_message, conf):
     return HttpResponse(failed_view)
 
 
+def remove_file(filepath):
+    """Remove a file in storage if it exists."""
+    try:
+        os.remove(filepath)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise FileWriteError(filepath)
+
+
+def make_parent_dirs(filepath):
+    """Create the parent directories of a file in storage."""
+    try:
+        os.makedirs(os.path.dirname(filepath))
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
 def successful_response(account, avatar, conf):
     """Generate response that shows add avatar successful page."""
     template_args = dict(
@@ -48,43 +67,77 @@ def successful_response(account, avatar, conf):
 @httpfilters.allow_methods('POST')
 def handler(request, conf):
     """The handler function."""
-    with MySQLDatabase(conf.get('database_connection')) as db:
+    with _databasehelper.open_database(conf) as db:
         # Try to get signed account
         try:
-            account = _accounthelper.get_session_account(request, db)
+            account = _accounthelper.get_session_account(request, db, conf)
         except _accounthelper.InvalidSessionException as e:
             return e.response
 
-        # Check uploaded file item
-        avatar_fileitem = request.field_storage['avatar_file']
+        # Check uploaded file item, which has been written to a temporary
+        # file in storage while parsing the request
+        if 'avatar_file' in request.field_storage:
+            avatar_fileitem = request.field_storage['avatar_file']
+        else:
+            avatar_fileitem = None
         if avatar_fileitem is None or not avatar_fileitem.filename:
             return failed_response(account,
                                    'please choose an image file.',
                                    conf)
-
-        # Get path to the file that should be written in server
-        _, file_extension = os.path.splitext(avatar_fileitem.filename)
-        filename = 'avatars/' + str_generator.unique_id() + file_extension
+        temp_filepath = avatar_fileitem.temp_filepath
+        content_hash = avatar_fileitem.sha1_hexdigest
+
+        # Get path to the file, which is shared by avatars with same content
+        blob = AvatarBlob.load_by_content_hash(db, content_hash)
+        if blob is not None:
+            filename = blob['file_path']
+        else:
+            _, file_extension = os.path.splitext(avatar_fileitem.filename)
+            filename = config.avatar_filename(content_hash + file_extension)
         filepath = config.storage_filepath(filename)
 
-        # Write uploaded file to storage
+        if Avatar.file_path_exists(db, account, filename):
+            return failed_response(account,
+                                   'the avatar is already added.',
+                                   conf)
+
+        # Reference the file before writing it, so that it is not removed
+        # by deleting another avatar with the same content. Another request
+        # may have stored the content with another path meanwhile
+        referenced_filename = AvatarBlob.add_reference(db, filename,
+                                                       content_hash)
+        if referenced_filename != filename:
+            filename = referenced_filename
+            filepath = config.storage_filepath(filename)
+            if Avatar.file_path_exists(db, account, filename):
+                AvatarBlob.remove_reference(db, filename,
+                                            lambda: remove_file(filepath))
+                return failed_response(account,
+                                       'the avatar is already added.',
+                                       conf)
+
+        # The temporary file is linked to the path atomically and removed
+        # with the request
         try:
-            with open(filepath, 'wb') as avatar_file:
-                avatar_file.write(avatar_fileitem.file.read())
-        except IOError as e:
-            raise FileWriteError(filepath)
+            make_parent_dirs(filepath)
+            os.link(temp_filepath, filepath)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                AvatarBlob.remove_reference(db, filename)
+                raise FileWriteError(filepath)
 
         # Create avatar instance in database
         avatar = Avatar.create_avatar(db, account, filename)
         if avatar is None:
-            # Remove the written file if failed to create
-            try:
-                os.remove(filepath)
-            except OSError as e:
-                raise FileWriteError(filepath)
+            # Remove the file if it is not referenced by others
+            AvatarBlob.remove_reference(db, filename,
+                                        lambda: remove_file(filepath))
 
             return failed_response(account,
                                    'cannot add account',
                                    conf)
 
+        # Process the image in the background
+        _jobhelper.enqueue_avatar_processing(avatar, conf)
+
         return successful_response(account, avatar, conf)
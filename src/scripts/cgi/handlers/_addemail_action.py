@@ -3,12 +3,13 @@
 
 import re
 from ng import httpfilters
-from ng.database import MySQLDatabase
 from ng.http import HttpResponse, HttpRedirectResponse
 from ng.models import Email
 from ng.views import TemplateView
 import config
 import _accounthelper
+import _avatarhelper
+import _databasehelper
 
 
 def failed_response(account, error_message, conf):
@@ -51,10 +52,10 @@ def check_email_format(email):
 @httpfilters.allow_methods('POST')
 def handler(request, conf):
     """The handler function."""
-    with MySQLDatabase(conf.get('database_connection')) as db:
+    with _databasehelper.open_database(conf) as db:
         # Try to get signed account
         try:
-            account = _accounthelper.get_session_account(request, db)
+            account = _accounthelper.get_session_account(request, db, conf)
         except _accounthelper.InvalidSessionException as e:
             return e.response
 
@@ -91,5 +92,6 @@ def handler(request, conf):
             return failed_response(account,
                                    'cannot add email',
                                    conf)
+        _avatarhelper.email_hash_added(email.get('email_hash'), conf)
 
         return successful_response(account, email, conf)
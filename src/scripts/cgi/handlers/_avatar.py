@@ -2,52 +2,34 @@
 
 
 from ng import httpfilters
-from ng.database import MySQLDatabase
-from ng.http import HttpResponse, HttpErrorResponse
 from ng.models import Avatar
-from ng.views import TemplateView, ImageView, StaticView
-import config
 import _accounthelper
-
-
-def http_error_response(error_code, conf):
-    """Generate response that indicates an http error."""
-    error_page_path = config.static_filepath(
-        conf['error_pages'].get(error_code)
-    )
-    error_view = StaticView(error_page_path)
-
-    response = HttpErrorResponse(error_code, error_view)
-    return response
-
-
-def avatar_response(avatar, conf):
-    """Generate response that shows the avatar image."""
-    avatar_path = config.storage_filepath(avatar.get('file_path'))
-    avatar_view = ImageView(avatar_path)
-    return HttpResponse(avatar_view)
+import _avatarhelper
+import _databasehelper
+import _errorhelper
 
 
 @httpfilters.allow_methods('GET')
 def handler(request, conf):
     """The handler function."""
-    with MySQLDatabase(conf.get('database_connection')) as db:
+    with _databasehelper.open_database(conf) as db:
         # Try to get signed account
         try:
-            account = _accounthelper.get_session_account(request, db)
+            account = _accounthelper.get_session_account(request, db, conf)
         except _accounthelper.InvalidSessionException as e:
             return e.response
 
         # Check the id in the query string
         aid = int(request.field_storage.getvalue('id', 0))
         if not aid:
-            return http_error_response(404, conf)
+            return _errorhelper.http_error_response(404, request, conf)
 
         # Load the avatar instance from database
         avatar = Avatar.load_from_database(db,
                                            owner_uid=account.get('uid'),
                                            aid=aid)
         if avatar is None:
-            return http_error_response(403, conf)
+            return _errorhelper.http_error_response(403, request, conf)
 
-        return avatar_response(avatar, conf)
+        size = request.field_storage.getvalue('s')
+        return _avatarhelper.avatar_response(request, avatar, conf, size)
@@ -0,0 +1,35 @@
+"""This module defines the handler that handles requests of avatar images
+with URLs derived from their content."""
+
+
+from ng import httpfilters
+import _avatarhelper
+import _errorhelper
+
+
+@httpfilters.allow_methods('GET')
+def handler(request, conf):
+    """The handler function."""
+    # Get path and digest of the avatar file
+    file_path = request.field_storage.getvalue('path')
+    digest = request.field_storage.getvalue('sha1')
+    if not digest or not _avatarhelper.valid_avatar_file_path(file_path):
+        return _errorhelper.http_error_response(404, request, conf)
+
+    # Generate the resized image again if it has been evicted
+    source = _avatarhelper.variant_source(file_path)
+    if source is not None:
+        original_path, size = source
+        if _avatarhelper.resized_avatar_path(original_path, size,
+                                             conf) != file_path:
+            return _errorhelper.http_error_response(404, request, conf)
+
+    # The content of an immutable URL must never change
+    avatar = dict(file_path=file_path)
+    if _avatarhelper.avatar_digest(avatar) != digest.lower():
+        return _errorhelper.http_error_response(404, request, conf)
+
+    response = _avatarhelper.avatar_response(request, avatar, conf)
+    response.add_header('Cache-Control',
+                        _avatarhelper.IMMUTABLE_CACHE_CONTROL)
+    return response
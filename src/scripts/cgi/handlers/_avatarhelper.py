@@ -0,0 +1,541 @@
+"""This module defines helper functions that resolve avatars for the public
+avatar API and generate avatar image responses."""
+
+
+import errno
+import os
+import posixpath
+import re
+import threading
+import time
+import urllib
+from ng import images
+from ng import str_generator
+from ng.caches import BlobCache, BloomFilter, InvalidationStamp, LRUCache
+from ng.excepts import FileLocateError, FileReadError, FileWriteError
+from ng.http import HttpResponse, HttpNotModifiedResponse, http_date
+from ng.models import Avatar, AvatarVariant, Email
+from ng.views import FileOffload, ImageView
+import config
+import _databasehelper
+
+
+# Cache-Control header of responses whose URL changes with the content
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# Pattern of names of resized avatar images, which are <name>-s<size><ext>
+_VARIANT_PATTERN = re.compile(r'^(.+)-s(\d+)(\.[^./]*)?$')
+
+
+# Cache of email hash -> Avatar, created with the configuration
+_avatar_cache = None
+
+# Cache of email hashes that have no avatar, created with the configuration
+_negative_cache = None
+
+# Cache of avatar image files, created with the configuration
+_blob_cache = None
+
+# Cache of ETag -> SHA1 digest of avatar image files
+_digest_cache = LRUCache(10000)
+
+# Bloom filter of registered email hashes and the time it was built
+_email_hash_filter = None
+_email_hash_filter_time = 0
+_email_hash_filter_lock = threading.Lock()
+
+# Greatest id of emails in the filter and the time it was last synced with
+# the database. The lock protects adding to and replacing the filter.
+_email_hash_filter_emid = 0
+_email_hash_sync_time = 0
+_email_hash_sync_lock = threading.Lock()
+
+
+def _invalidation_stamp(cache_conf):
+    """Return the stamp shared with other processes that is kept in the
+    'invalidation_file' of a cache configuration. None is returned if it is
+    not configured."""
+    if not cache_conf.get('invalidation_file'):
+        return None
+
+    return InvalidationStamp(
+        config.storage_filepath(cache_conf['invalidation_file']))
+
+
+def _get_avatar_cache(conf):
+    """Return the avatar cache. None is returned if 'avatar_cache' is not
+    configured."""
+    global _avatar_cache
+
+    cache_conf = conf.get('avatar_cache')
+    if cache_conf is None:
+        return None
+
+    if _avatar_cache is None:
+        _avatar_cache = LRUCache(cache_conf.get('max_entries', 1024),
+                                 cache_conf.get('ttl_seconds'),
+                                 _invalidation_stamp(cache_conf))
+
+    return _avatar_cache
+
+
+def _get_negative_cache(conf):
+    """Return the cache of email hashes without avatar. None is returned if
+    'avatar_negative_cache' is not configured."""
+    global _negative_cache
+
+    cache_conf = conf.get('avatar_negative_cache')
+    if cache_conf is None:
+        return None
+
+    if _negative_cache is None:
+        _negative_cache = LRUCache(cache_conf.get('max_entries', 1024),
+                                   cache_conf.get('ttl_seconds'),
+                                   _invalidation_stamp(cache_conf))
+
+    return _negative_cache
+
+
+def _get_blob_cache(conf):
+    """Return the cache of avatar image files. None is returned if
+    'avatar_blob_cache' is not enabled."""
+    global _blob_cache
+
+    cache_conf = conf.get('avatar_blob_cache')
+    if not cache_conf or not cache_conf.get('enabled'):
+        return None
+
+    if _blob_cache is None:
+        _blob_cache = BlobCache(cache_conf.get('max_bytes', 67108864),
+                                cache_conf.get('mmap_min_bytes', 262144))
+
+    return _blob_cache
+
+
+def _add_email_hashes(hash_filter, rows):
+    """Add email hashes to the filter. rows are tuples (id, hash) ordered by
+    id. Return the greatest id, or None if rows is empty."""
+    for _, email_hash in rows:
+        hash_filter.add(email_hash)
+
+    if not rows:
+        return None
+    return rows[-1][0]
+
+
+def build_email_hash_filter(db, conf):
+    """Build the Bloom filter of email hashes with all emails in database.
+    Nothing is done if the filter is not enabled."""
+    global _email_hash_filter, _email_hash_filter_time
+    global _email_hash_filter_emid, _email_hash_sync_time
+
+    filter_conf = conf.get('email_hash_filter')
+    if not filter_conf or not filter_conf.get('enabled'):
+        return
+
+    rows = Email.load_email_hashes_after(db)
+
+    # Leave room for emails added before the next rebuild
+    capacity = max(filter_conf.get('capacity', 1000000), 2 * len(rows))
+    hash_filter = BloomFilter(capacity, filter_conf.get('error_rate', 0.001))
+    emid = _add_email_hashes(hash_filter, rows) or 0
+
+    # Apply emails added while scanning, then replace the filter before
+    # anything else is added to the old one
+    with _email_hash_sync_lock:
+        rows = Email.load_email_hashes_after(
+            db, _email_hash_sync_after(emid, filter_conf))
+        emid = max(_add_email_hashes(hash_filter, rows) or 0, emid)
+        _email_hash_filter = hash_filter
+        _email_hash_filter_emid = emid
+        _email_hash_filter_time = _email_hash_sync_time = time.time()
+
+
+def _email_hash_sync_after(emid, filter_conf):
+    """Return the id after which emails are synced when emid is the greatest
+    id in the filter. Ids are assigned before transactions commit, so emails
+    with lower ids may still be committed and the last sync_overlap ids are
+    scanned again."""
+    return max(0, emid - filter_conf.get('sync_overlap', 1000))
+
+
+def _sync_email_hash_filter(conf):
+    """Add emails added through other processes since the last sync to the
+    filter. The database is queried at most every sync_seconds seconds."""
+    global _email_hash_filter_emid, _email_hash_sync_time
+
+    filter_conf = conf['email_hash_filter']
+    sync_seconds = filter_conf.get('sync_seconds', 1)
+    if time.time() - _email_hash_sync_time < sync_seconds:
+        return
+
+    with _email_hash_sync_lock:
+        if time.time() - _email_hash_sync_time < sync_seconds:
+            return
+
+        with _databasehelper.open_database(conf) as db:
+            rows = Email.load_email_hashes_after(
+                db, _email_hash_sync_after(_email_hash_filter_emid,
+                                           filter_conf))
+
+        emid = _add_email_hashes(_email_hash_filter, rows)
+        if emid is not None:
+            _email_hash_filter_emid = max(_email_hash_filter_emid, emid)
+        _email_hash_sync_time = time.time()
+
+
+def _get_email_hash_filter(conf):
+    """Return the Bloom filter of email hashes, which is rebuilt if it is
+    too old. None is returned if the filter is not enabled."""
+    filter_conf = conf.get('email_hash_filter')
+    if not filter_conf or not filter_conf.get('enabled'):
+        return None
+
+    # Rebuild in one thread while others keep using the old filter
+    age = time.time() - _email_hash_filter_time
+    if _email_hash_filter is None or \
+            age > filter_conf.get('rebuild_seconds', 300):
+        if _email_hash_filter_lock.acquire(_email_hash_filter is None):
+            try:
+                with _databasehelper.open_database(conf) as db:
+                    build_email_hash_filter(db, conf)
+            finally:
+                _email_hash_filter_lock.release()
+
+    return _email_hash_filter
+
+
+def _email_hash_absent(email_hash, conf):
+    """Check whether the email hash is definitely not registered. Emails
+    added through other processes are synced before answering."""
+    hash_filter = _get_email_hash_filter(conf)
+    if hash_filter is None or email_hash in hash_filter:
+        return False
+
+    _sync_email_hash_filter(conf)
+    return email_hash not in _email_hash_filter
+
+
+def preload(conf):
+    """Build the Bloom filter of email hashes if it is enabled."""
+    _get_email_hash_filter(conf)
+
+
+def load_avatar_by_email_hash(email_hash, conf):
+    """Return the avatar set to the email with email_hash. The database is
+    only queried if the result is not cached and the hash may be registered.
+    None is returned if no avatar is set to the email. The returned avatar
+    is a copy that callers may change."""
+    cache = _get_avatar_cache(conf)
+    if cache is not None:
+        avatar = cache.get(email_hash)
+        if avatar is not None:
+            return Avatar(avatar)
+        generation = cache.generation
+
+    # Check whether the hash is known to have no avatar
+    negative_cache = _get_negative_cache(conf)
+    if negative_cache is not None:
+        if negative_cache.get(email_hash):
+            return None
+        negative_generation = negative_cache.generation
+
+    # Check whether the hash is definitely not registered
+    if _email_hash_absent(email_hash, conf):
+        return None
+
+    with _databasehelper.open_database(conf) as db:
+        avatar = Avatar.load_by_email_hash(db, email_hash)
+
+    # Results read before an invalidation in this process are not cached,
+    # since they may be older than the change that invalidated them
+    if avatar is None:
+        if negative_cache is not None:
+            negative_cache.set(email_hash, True, negative_generation)
+    elif cache is not None:
+        cache.set(email_hash, Avatar(avatar), generation)
+
+    return avatar
+
+
+def _file_offload(conf):
+    """Return the FileOffload setting in the configuration. None is returned
+    if files are sent by this site."""
+    offload_conf = conf.get('file_offload') or {}
+    if not offload_conf.get('mode'):
+        return None
+
+    return FileOffload(offload_conf['mode'],
+                       conf.get('storage_path'),
+                       offload_conf.get('accel_prefix'))
+
+
+def _size_bucket(size, conf):
+    """Return the smallest configured size of resized avatars that is not
+    less than size. None is returned if the original image should be used."""
+    sizes_conf = conf.get('avatar_sizes')
+    if not sizes_conf or not images.resizing_available():
+        return None
+
+    try:
+        size = int(size)
+    except (TypeError, ValueError):
+        return None
+
+    for bucket in sorted(sizes_conf.get('buckets', ())):
+        if 0 < size <= bucket:
+            return bucket
+
+    return None
+
+
+def variant_file_path(file_path, size):
+    """Return path in storage of the avatar image file_path resized to
+    size."""
+    root, extension = posixpath.splitext(file_path)
+    return '%s-s%d%s' % (root, size, extension)
+
+
+def variant_source(file_path):
+    """Return tuple (original file path, size) of a resized avatar image.
+    None is returned if file_path is not a resized avatar image."""
+    match = _VARIANT_PATTERN.match(file_path)
+    if match is None:
+        return None
+
+    root, size, extension = match.groups()
+    return root + (extension or ''), int(size)
+
+
+def _touch_variant(variant_path, stat, conf):
+    """Record access of a resized avatar image for LRU eviction. Only the
+    access time of the file is changed so that validators of the image are
+    kept. Images that are not recorded yet, such as images generated before
+    recording, are recorded with their sizes."""
+    variant_filepath = config.storage_filepath(variant_path)
+    now = time.time()
+    if now - stat.st_atime <= 60:
+        return
+
+    try:
+        os.utime(variant_filepath, (now, stat.st_mtime))
+    except OSError:
+        pass
+
+    if conf['avatar_sizes'].get('max_bytes') is not None:
+        with _databasehelper.open_database(conf) as db:
+            if not AvatarVariant.touch(db, variant_path):
+                AvatarVariant.record(db, variant_path, stat.st_size)
+
+
+def _remove_variant_file(variant_filepath):
+    """Remove a resized avatar image file if it exists."""
+    try:
+        os.remove(variant_filepath)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise FileWriteError(variant_filepath)
+
+
+def _trim_variants(db, conf, keep_path, batch_size=16):
+    """Remove least recently used resized avatar images until they fit in
+    the configured byte budget. The image keep_path is never removed. Only
+    the recorded sizes are read, so the storage is not scanned."""
+    max_bytes = conf['avatar_sizes'].get('max_bytes')
+    excess_bytes = AvatarVariant.total_bytes(db) - max_bytes
+
+    while excess_bytes > 0:
+        variants = [variant for variant in
+                    AvatarVariant.least_recently_used(db, batch_size)
+                    if variant['file_path'] != keep_path]
+        if not variants:
+            break
+
+        for variant in variants:
+            variant_filepath = config.storage_filepath(variant['file_path'])
+            excess_bytes -= AvatarVariant.remove(
+                db, variant['file_path'],
+                lambda: _remove_variant_file(variant_filepath))
+            if excess_bytes <= 0:
+                break
+
+
+def _record_variant(variant_path, conf):
+    """Record a generated resized avatar image and remove least recently
+    used images if they exceed the byte budget."""
+    if conf['avatar_sizes'].get('max_bytes') is None:
+        return
+
+    try:
+        size_bytes = os.stat(config.storage_filepath(variant_path)).st_size
+    except OSError:
+        return
+
+    with _databasehelper.open_database(conf) as db:
+        AvatarVariant.record(db, variant_path, size_bytes)
+        _trim_variants(db, conf, variant_path)
+
+
+def resized_avatar_path(file_path, size, conf):
+    """Return path in storage of the avatar image file_path resized to the
+    bucket of size. The resized image is generated once and reused later.
+    file_path is returned if the original image should be served."""
+    bucket = _size_bucket(size, conf)
+    if bucket is None:
+        return file_path
+
+    variant_path = variant_file_path(file_path, bucket)
+    source_filepath = config.storage_filepath(file_path)
+    variant_filepath = config.storage_filepath(variant_path)
+
+    try:
+        source_mtime = os.stat(source_filepath).st_mtime
+    except OSError:
+        return file_path
+
+    # Use the existing resized image if it is newer than the original
+    try:
+        stat = os.stat(variant_filepath)
+    except OSError:
+        stat = None
+    if stat is not None and stat.st_mtime >= source_mtime:
+        _touch_variant(variant_path, stat, conf)
+        return variant_path
+
+    try:
+        if not images.resize_image(source_filepath, variant_filepath,
+                                   bucket):
+            # Link small images so that they are not checked again
+            if stat is not None:
+                os.remove(variant_filepath)
+            os.link(source_filepath, variant_filepath)
+    except (IOError, OSError):
+        return file_path
+
+    _record_variant(variant_path, conf)
+    return variant_path
+
+
+def remove_avatar_variants(file_path, conf):
+    """Remove resized images of the avatar image file_path. It must be
+    called after deleting an avatar."""
+    sizes_conf = conf.get('avatar_sizes') or {}
+    if not sizes_conf.get('buckets'):
+        return
+
+    with _databasehelper.open_database(conf) as db:
+        for bucket in sizes_conf['buckets']:
+            variant_path = variant_file_path(file_path, bucket)
+            variant_filepath = config.storage_filepath(variant_path)
+            AvatarVariant.remove(
+                db, variant_path,
+                lambda: _remove_variant_file(variant_filepath))
+
+
+def avatar_response(request, avatar, conf, size=None):
+    """Generate response that shows the avatar image, resized to fit in a
+    square of size pixels if size is given. A not modified response is
+    returned if the client's cached copy is still valid."""
+    file_path = resized_avatar_path(avatar.get('file_path'), size, conf)
+    avatar_path = config.storage_filepath(file_path)
+    avatar_view = ImageView(avatar_path,
+                            offload=_file_offload(conf),
+                            blob_cache=_get_blob_cache(conf))
+
+    # Check validators before reading the image file
+    etag, last_modified = avatar_view.validators()
+    if request.not_modified(etag, last_modified):
+        response = HttpNotModifiedResponse()
+    else:
+        response = HttpResponse(avatar_view)
+
+    response.add_header('ETag', etag)
+    response.add_header('Last-Modified', http_date(last_modified))
+    return response
+
+
+def avatar_digest(avatar):
+    """Return the SHA1 hex digest of the avatar image. The digest is only
+    computed when the image file changes."""
+    avatar_path = config.storage_filepath(avatar.get('file_path'))
+    etag, _ = ImageView(avatar_path).validators()
+
+    digest = _digest_cache.get(etag)
+    if digest is None:
+        try:
+            with open(avatar_path, 'rb') as avatar_file:
+                digest = str_generator.sha1_file_hexdigest(avatar_file)
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                raise FileLocateError(avatar_path)
+            else:
+                raise FileReadError(avatar_path)
+        _digest_cache.set(etag, digest)
+
+    return digest
+
+
+def valid_avatar_file_path(file_path):
+    """Check whether file_path is a normalized path in the avatar storage
+    directory."""
+    if not file_path or posixpath.normpath(file_path) != file_path:
+        return False
+
+    return file_path.startswith('avatars/') and \
+        '..' not in file_path.split('/')
+
+
+def immutable_avatar_url(avatar, conf, size=None):
+    """Return the URL of the avatar image resized to size that is derived
+    from the image content, so that it can be cached forever."""
+    file_path = resized_avatar_path(avatar.get('file_path'), size, conf)
+    query = urllib.urlencode([
+        ('path', file_path),
+        ('sha1', avatar_digest(dict(file_path=file_path))),
+    ])
+    return '/avatar/file?' + query
+
+
+def email_hash_added(email_hash, conf):
+    """Record a new email hash. It must be called after adding an email."""
+    # Wait for a rebuilding filter to replace the old one
+    with _email_hash_sync_lock:
+        if _email_hash_filter is not None:
+            _email_hash_filter.add(email_hash)
+
+    invalidate_email_hash(email_hash, conf)
+
+
+def invalidate_email_hash(email_hash, conf):
+    """Remove the cached avatar of the email with email_hash. It must be
+    called after changing the avatar of an email. Caches with an
+    'invalidation_file' are also invalidated in the other processes of the
+    host, even if this process hasn't used them."""
+    cache = _get_avatar_cache(conf)
+    if cache is not None:
+        cache.invalidate(email_hash)
+
+    negative_cache = _get_negative_cache(conf)
+    if negative_cache is not None:
+        negative_cache.invalidate(email_hash)
+
+
+def cache_stats():
+    """Return counters of the caches as a dictionary."""
+    stats = {}
+
+    if _avatar_cache is not None:
+        stats['avatar_cache'] = _avatar_cache.stats()
+
+    if _negative_cache is not None:
+        stats['avatar_negative_cache'] = _negative_cache.stats()
+
+    if _blob_cache is not None:
+        stats['avatar_blob_cache'] = _blob_cache.stats()
+
+    if _email_hash_filter is not None:
+        stats['email_hash_filter'] = dict(
+            entries=len(_email_hash_filter),
+            age_seconds=time.time() - _email_hash_filter_time)
+
+    return stats
@@ -0,0 +1,17 @@
+"""This module defines helper function that opens database connections."""
+
+
+from ng.database import MySQLDatabase, PooledMySQLDatabase
+
+
+def open_database(conf):
+    """Return database object connected with the parameters in the
+    configuration. The connection is borrowed from a pool if 'database_pool'
+    is configured."""
+    connect_params = conf.get('database_connection')
+    pool_params = conf.get('database_pool')
+
+    if pool_params is not None:
+        return PooledMySQLDatabase(connect_params, **pool_params)
+    else:
+        return MySQLDatabase(connect_params)
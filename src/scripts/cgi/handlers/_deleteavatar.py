@@ -4,13 +4,14 @@
 import errno
 import os
 from ng import httpfilters
-from ng.database import MySQLDatabase
 from ng.excepts import FileWriteError
 from ng.http import HttpResponse, HttpRedirectResponse
-from ng.models import Avatar
+from ng.models import Avatar, AvatarBlob, Email
 from ng.views import TemplateView
 import config
 import _accounthelper
+import _avatarhelper
+import _databasehelper
 
 
 def failed_response(account, error_message, conf):
@@ -44,13 +45,25 @@ def successful_response(account, conf):
     return HttpResponse(successful_view)
 
 
+def remove_avatar_files(file_path, conf):
+    """Remove the avatar image file_path and its resized images."""
+    _avatarhelper.remove_avatar_variants(file_path, conf)
+
+    avatar_path = config.storage_filepath(file_path)
+    try:
+        os.remove(avatar_path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise FileWriteError(avatar_path)
+
+
 @httpfilters.allow_methods('GET', 'POST')
 def handler(request, conf):
     """The handler function."""
-    with MySQLDatabase(conf.get('database_connection')) as db:
+    with _databasehelper.open_database(conf) as db:
         # Try to get signed account
         try:
-            account = _accounthelper.get_session_account(request, db)
+            account = _accounthelper.get_session_account(request, db, conf)
         except _accounthelper.InvalidSessionException as e:
             return e.response
 
@@ -66,14 +79,19 @@ def handler(request, conf):
         if avatar is None:
             return failed_response(account, 'invalid avatar ID', conf)
 
+        # Find emails that the avatar is set to before deleting it
+        emails = Email.load_multiple_from_database(db, avatar_id=aid)
+
         if not avatar.delete_from_database(db):
             return failed_response(account, 'cannot delete avatar', conf)
 
-        avatar_path = config.storage_filepath(avatar.get('file_path'))
-        try:
-            os.remove(avatar_path)
-        except OSError as e:
-            if e.errno != errno.ENOENT:
-                raise FileWriteError(avatar_path)
+        for email in emails:
+            _avatarhelper.invalidate_email_hash(email.get('email_hash'), conf)
+
+        # The file may be shared by other avatars with the same content
+        AvatarBlob.remove_reference(
+            db, avatar.get('file_path'),
+            lambda: remove_avatar_files(avatar.get('file_path'), conf)
+        )
 
         return successful_response(account, conf)
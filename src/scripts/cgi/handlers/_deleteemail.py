@@ -2,12 +2,13 @@
 
 
 from ng import httpfilters
-from ng.database import MySQLDatabase
 from ng.http import HttpResponse, HttpRedirectResponse
 from ng.models import Email
 from ng.views import TemplateView
 import config
 import _accounthelper
+import _avatarhelper
+import _databasehelper
 
 
 def failed_response(account, error_message, conf):
@@ -45,10 +46,10 @@ def successful_response(account, email, conf):
 @httpfilters.allow_methods('GET', 'POST')
 def handler(request, conf):
     """The handler function."""
-    with MySQLDatabase(conf.get('database_connection')) as db:
+    with _databasehelper.open_database(conf) as db:
         # Try to get signed account
         try:
-            account = _accounthelper.get_session_account(request, db)
+            account = _accounthelper.get_session_account(request, db, conf)
         except _accounthelper.InvalidSessionException as e:
             return e.response
 
@@ -66,6 +67,7 @@ def handler(request, conf):
 
         # Delete email from database
         if email.delete_from_database(db):
+            _avatarhelper.invalidate_email_hash(email.get('email_hash'), conf)
             return successful_response(account, email, conf)
         else:
             return failed_response(
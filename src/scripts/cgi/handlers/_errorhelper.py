@@ -0,0 +1,137 @@
+"""This module defines helper functions that generate responses of HTTP
+errors. Error pages are loaded into memory once per process and their
+responses are built in advance, so that floods of errors don't read the
+disk."""
+
+
+import errno
+import os
+import time
+from ng.excepts import FileLocateError, FileReadError
+from ng.http import HttpErrorResponse, HttpPrebuiltResponse
+from ng.http import negotiate_encoding, status_header
+from ng.views import StaticView, encode_content
+import config
+
+
+class _ErrorPage(object):
+    """Error page loaded into memory with its responses."""
+
+    def __init__(self, filepath, stat):
+        """Load the error page file. stat is tuple (modified time, size) of
+        the file."""
+        self.filepath = filepath
+        self.stat = stat
+        self.checked_time = time.time()
+        self.content = StaticView(filepath).render_body()
+
+        # Content coding -> prebuilt response, None for no coding
+        self.responses = {}
+
+
+# Error code -> error page
+_error_pages = {}
+
+
+def _stat_page(filepath):
+    """Return tuple (modified time, size) of an error page file. None is
+    returned if there is no error page."""
+    if not filepath:
+        return None
+
+    try:
+        stat = os.stat(filepath)
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            raise FileLocateError(filepath)
+        else:
+            raise FileReadError(filepath)
+
+    return stat.st_mtime, stat.st_size
+
+
+def _get_error_page(error_code, conf, check_seconds):
+    """Return the loaded error page of the error code. The file is checked
+    for changes at most every check_seconds seconds and loaded again if it
+    is changed."""
+    filepath = config.static_filepath(conf['error_pages'].get(error_code))
+
+    error_page = _error_pages.get(error_code)
+    if error_page is not None and error_page.filepath == filepath and \
+            time.time() - error_page.checked_time < check_seconds:
+        return error_page
+
+    stat = _stat_page(filepath)
+    if error_page is None or error_page.filepath != filepath or \
+            error_page.stat != stat:
+        error_page = _ErrorPage(filepath, stat)
+        _error_pages[error_code] = error_page
+    else:
+        error_page.checked_time = time.time()
+
+    return error_page
+
+
+def _prebuilt_response(error_page, error_code, encoding, vary,
+                       min_bytes=1024, level=6):
+    """Return the prebuilt response of the error page compressed with the
+    content coding. Pages of at least min_bytes bytes are compressed with
+    level, and the response without coding is used if the page is smaller
+    or compressing doesn't make it smaller."""
+    response = error_page.responses.get(encoding)
+    if response is not None:
+        return response
+
+    headers = {
+        'Status': status_header(error_code),
+        'Content-Type': 'text/html',
+    }
+    if vary:
+        headers['Vary'] = 'Accept-Encoding'
+
+    content = error_page.content
+    if encoding is not None and len(content) >= min_bytes:
+        encoded_content = encode_content(content, encoding, level)
+        if len(encoded_content) < len(content):
+            content = encoded_content
+            headers['Content-Encoding'] = encoding
+
+    if encoding is None or 'Content-Encoding' in headers:
+        response = HttpPrebuiltResponse(content, **headers).build()
+    else:
+        # Keep the response without coding for the content coding, so that
+        # the page isn't compressed again for every error
+        response = _prebuilt_response(error_page, error_code, None, vary)
+    error_page.responses[encoding] = response
+    return response
+
+
+def http_error_response(error_code, request, conf):
+    """Generate response that indicates an HTTP error. The error page is
+    served from memory if 'error_page_cache' is configured, compressed for
+    the client of request if 'compression' is also configured. request may
+    be None if the error happens before it is parsed."""
+    cache_conf = conf.get('error_page_cache')
+    if cache_conf is None:
+        error_page_path = config.static_filepath(
+            conf['error_pages'].get(error_code)
+        )
+        return HttpErrorResponse(error_code, StaticView(error_page_path))
+
+    error_page = _get_error_page(error_code, conf,
+                                 cache_conf.get('check_seconds', 5))
+
+    # Negotiate the content coding of precompressed pages
+    encoding = None
+    compression_conf = conf.get('compression') or {}
+    precompress = bool(compression_conf) and \
+        cache_conf.get('precompress', True)
+    if precompress and request is not None:
+        encoding = negotiate_encoding(
+            request.accept_encoding,
+            compression_conf.get('encodings', ('gzip',))
+        )
+
+    return _prebuilt_response(error_page, error_code, encoding, precompress,
+                              compression_conf.get('min_bytes', 1024),
+                              compression_conf.get('level', 6)).copy()
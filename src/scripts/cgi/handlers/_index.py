@@ -2,12 +2,12 @@
 
 
 from ng import httpfilters
-from ng.database import MySQLDatabase
 from ng.http import HttpResponse
 from ng.models import Account
 from ng.views import TemplateView
 import config
 import _sessionhelper
+import _databasehelper
 
 
 def index_response(conf, account=None):
@@ -28,9 +28,9 @@ def index_response(conf, account=None):
 @httpfilters.allow_methods('GET')
 def handler(request, conf):
     """The handler function."""
-    with MySQLDatabase(conf.get('database_connection')) as db:
+    with _databasehelper.open_database(conf) as db:
         # Get session from database
-        session = _sessionhelper.get_session(request, db)
+        session = _sessionhelper.get_session(request, db, conf)
 
         # Check session, redirect request to /usermain if valid
         if session is None:
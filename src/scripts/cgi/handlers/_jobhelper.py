@@ -0,0 +1,93 @@
+"""This module defines helper functions that run post-processing jobs of
+uploaded avatars in the background."""
+
+
+import os
+from ng import images
+from ng.jobs import JobQueue
+import config
+import _avatarhelper
+
+
+# Queue of jobs, created with the configuration
+_job_queue = None
+
+
+def job_queue(conf):
+    """Return the job queue. None is returned if 'job_queue' is not
+    enabled."""
+    global _job_queue
+
+    queue_conf = conf.get('job_queue')
+    if not queue_conf or not queue_conf.get('enabled'):
+        return None
+
+    if _job_queue is None:
+        _job_queue = JobQueue(config.storage_filepath('jobs'),
+                              queue_conf.get('max_attempts', 3),
+                              queue_conf.get('retry_delay_seconds', 60))
+
+    return _job_queue
+
+
+def avatar_job_id(aid):
+    """Return ID of the post-processing job of an avatar."""
+    return 'avatar-%d' % aid
+
+
+def enqueue_avatar_processing(avatar, conf):
+    """Add the post-processing job of a new avatar. Nothing is done if the
+    job queue is not enabled."""
+    queue = job_queue(conf)
+    if queue is None:
+        return
+
+    args = dict(file_path=avatar.get('file_path'))
+    queue.enqueue('process_avatar', args, avatar_job_id(avatar.get('aid')))
+
+
+def avatar_job_statuses(avatars, conf):
+    """Return dictionary aid -> status of post-processing jobs of avatars.
+    Avatars without jobs are not included."""
+    queue = job_queue(conf)
+    if queue is None:
+        return {}
+
+    statuses = {}
+    for avatar in avatars:
+        status = queue.status(avatar_job_id(avatar.get('aid')))
+        if status is not None:
+            statuses[avatar.get('aid')] = status
+
+    return statuses
+
+
+def process_avatar(conf, file_path):
+    """Verify the uploaded avatar image and generate its resized images."""
+    avatar_path = config.storage_filepath(file_path)
+
+    # The avatar may have been deleted
+    if not os.path.exists(avatar_path):
+        return
+
+    images.verify_image(avatar_path)
+    if not images.resizing_available():
+        return
+
+    for bucket in conf.get('avatar_sizes', {}).get('buckets', ()):
+        if _avatarhelper.resized_avatar_path(file_path, bucket,
+                                             conf) == file_path:
+            raise IOError('cannot resize %s to %d' % (file_path, bucket))
+
+
+# Task name -> function that runs the task with configuration and arguments
+TASKS = dict(
+    process_avatar=process_avatar
+)
+
+
+def run_job(job, conf):
+    """Run the task of a job. Errors raised by the task are not caught."""
+    task = TASKS[job['task']]
+    args = dict((str(key), value) for key, value in job['args'].items())
+    task(conf, **args)
@@ -3,29 +3,80 @@ requests."""
 
 
 import datetime
+from ng.caches import InvalidationStamp, LRUCache
 from ng.http import DatabaseSession, HttpCookie
+import config
 
 
-def get_session(request, db):
-    """Extract valid session from request and return the session object.
-    None is returned if no valid session exists."""
-    # Check cookie
+# Cache of session key -> (session, account), created with the configuration
+_session_cache = None
+
+
+def _get_session_cache(conf):
+    """Return the cache of sessions. None is returned if 'session_cache' is
+    not configured."""
+    global _session_cache
+
+    cache_conf = conf.get('session_cache')
+    if cache_conf is None:
+        return None
+
+    if _session_cache is None:
+        stamp = None
+        if cache_conf.get('invalidation_file'):
+            stamp = InvalidationStamp(
+                config.storage_filepath(cache_conf['invalidation_file']))
+        _session_cache = LRUCache(cache_conf.get('max_entries', 10000),
+                                  cache_conf.get('ttl_seconds', 10),
+                                  stamp)
+
+    return _session_cache
+
+
+def _get_session_key(request):
+    """Return the session key in the cookie of request. None is returned if
+    there is no session key."""
     if request.cookie is None:
         return None
 
+    return request.cookie.data.get('SessionKey') or None
+
+
+def get_session(request, db, conf):
+    """Extract valid session from request and return the session object.
+    None is returned if no valid session exists."""
     # Check session key in the cookie
-    session_key = request.cookie.data.get('SessionKey')
+    session_key = _get_session_key(request)
     if not session_key:
         return None
 
     # Load session from database
-    session = DatabaseSession.load_session(db, session_key)
+    session = DatabaseSession.load_session(db, session_key,
+                                           _get_session_cache(conf))
     if session is None:
         return None
 
     return session
 
 
+def get_session_with_account(request, db, conf):
+    """Extract valid session from request with the account signed in with
+    it. Return tuple (session object, Account object). The account is None
+    if the session is not linked to an existing account, and (None, None)
+    is returned if no valid session exists."""
+    # Check session key in the cookie
+    session_key = _get_session_key(request)
+    if not session_key:
+        return None, None
+
+    # Load session and account from cache or database
+    return DatabaseSession.load_session_with_account(
+        db,
+        session_key,
+        _get_session_cache(conf)
+    )
+
+
 def _expired_time():
     """Return a datetime object that is smaller than now."""
     return datetime.datetime.now() - datetime.timedelta(1)
@@ -2,12 +2,12 @@
 
 
 from ng import httpfilters
-from ng.database import MySQLDatabase
 from ng.models import Account, Email, Avatar
 from ng.http import HttpCookie, HttpResponse, HttpRedirectResponse
 from ng.views import TemplateView
 import config
 import _accounthelper
+import _databasehelper
 
 
 def failed_response(account, error_message, conf):
@@ -53,10 +53,10 @@ def setavatar_response(db, account, email, conf):
 @httpfilters.allow_methods('GET')
 def handler(request, conf):
     """The handler function."""
-    with MySQLDatabase(conf.get('database_connection')) as db:
+    with _databasehelper.open_database(conf) as db:
         # Try to get the signed in account
         try:
-            account = _accounthelper.get_session_account(request, db)
+            account = _accounthelper.get_session_account(request, db, conf)
         except _accounthelper.InvalidSessionException as e:
             return e.response
 
@@ -3,12 +3,13 @@ requests."""
 
 
 from ng import httpfilters
-from ng.database import MySQLDatabase
 from ng.http import HttpResponse, HttpRedirectResponse
 from ng.models import Account, Email, Avatar
 from ng.views import TemplateView
 import config
 import _accounthelper
+import _avatarhelper
+import _databasehelper
 
 
 def failed_response(account, error_message, conf):
@@ -63,10 +64,10 @@ def remove_avatar_response(account, email, conf):
 @httpfilters.allow_methods('POST')
 def handler(request, conf):
     """The handler function."""
-    with MySQLDatabase(conf.get('database_connection')) as db:
+    with _databasehelper.open_database(conf) as db:
         # Try to get signed account
         try:
-            account = _accounthelper.get_session_account(request, db)
+            account = _accounthelper.get_session_account(request, db, conf)
         except _accounthelper.InvalidSessionException as e:
             return e.response
 
@@ -91,6 +92,8 @@ def handler(request, conf):
         if aid == 0:
             email['avatar_id'] = None
             if email.update_to_database(db, 'avatar_id'):
+                _avatarhelper.invalidate_email_hash(email.get('email_hash'),
+                                                    conf)
                 return remove_avatar_response(account, email, conf)
             else:
                 return failed_response(
@@ -106,10 +109,10 @@ def handler(request, conf):
             return failed_response(account, 'cannot find avatar', conf)
 
         # Set the avatar to the email
-        email['avatar_id'] = aid
-        if not email.update_to_database(db, 'avatar_id'):
+        if not email.set_avatar(db, avatar):
             return failed_response(account,
                                    'cannot set this avatar for the email',
                                    conf)
+        _avatarhelper.invalidate_email_hash(email.get('email_hash'), conf)
 
         return successful_response(account, email, avatar, conf)
@@ -2,11 +2,11 @@
 
 
 from ng import httpfilters
-from ng.database import MySQLDatabase
 from ng.http import HttpResponse, HttpRedirectResponse
 from ng.views import TemplateView
 import config
 import _sessionhelper
+import _databasehelper
 
 
 def signin_response(request, conf):
@@ -30,9 +30,9 @@ def signin_response(request, conf):
 @httpfilters.allow_methods('GET')
 def handler(request, conf):
     """The handler function."""
-    with MySQLDatabase(conf.get('database_connection')) as db:
+    with _databasehelper.open_database(conf) as db:
         # Get session from database
-        session = _sessionhelper.get_session(request, db)
+        session = _sessionhelper.get_session(request, db, conf)
 
         # Check session, redirect request to user main page if valid
         if session is not None:
@@ -2,12 +2,12 @@
 
 
 from ng import httpfilters
-from ng.database import MySQLDatabase
 from ng.http import HttpCookie, DatabaseSession
 from ng.http import HttpResponse, HttpRedirectResponse
 from ng.models import Account
 from ng.views import TemplateView
 import config
+import _databasehelper
 
 
 def failed_response(error_message, conf):
@@ -41,7 +41,7 @@ def handler(request, conf):
         return failed_response('please input your password', conf)
 
     # Connect database and do sign in action
-    with MySQLDatabase(conf.get('database_connection')) as db:
+    with _databasehelper.open_database(conf) as db:
         # Check username existance in database
         if not Account.username_exists(db, username):
             return failed_response('username %s does not exist' % username,
@@ -64,7 +64,8 @@ def handler(request, conf):
             db,
             session_data,
             request.client_addr,
-            conf.get('session_effective_hours', 72)
+            conf.get('session_effective_hours', 72),
+            uid
         )
 
         # Check session
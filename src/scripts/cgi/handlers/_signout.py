@@ -3,11 +3,11 @@
 
 import datetime
 from ng import httpfilters
-from ng.database import MySQLDatabase
 from ng.http import HttpResponse, HttpRedirectResponse, HttpCookie
 from ng.views import TemplateView
 import config
 import _sessionhelper
+import _databasehelper
 
 
 @httpfilters.allow_methods('GET')
@@ -16,9 +16,9 @@ def handler(request, conf):
     # Redirect this request to sign in page
     response = HttpRedirectResponse('/signin')
 
-    with MySQLDatabase(conf.get('database_connection')) as db:
+    with _databasehelper.open_database(conf) as db:
         # Get session from database
-        session = _sessionhelper.get_session(request, db)
+        session = _sessionhelper.get_session(request, db, conf)
 
         # Remove session from database and generate session expiring cookie
         if session is not None:
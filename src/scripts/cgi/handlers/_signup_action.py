@@ -2,11 +2,11 @@
 
 
 from ng.views import TemplateView
-from ng.database import MySQLDatabase
 from ng.models import Account
 from ng.http import HttpResponse
 from ng import httpfilters
 import config
+import _databasehelper
 
 
 def failed_response(error_message, conf):
@@ -55,7 +55,7 @@ def handler(request, conf):
         return failed_response('please input your password', conf)
 
     # Create account in database
-    with MySQLDatabase(conf.get('database_connection')) as db:
+    with _databasehelper.open_database(conf) as db:
         # Check username existance
         if Account.username_exists(db, username):
             return failed_response(
@@ -2,12 +2,13 @@
 
 
 from ng import httpfilters
-from ng.database import MySQLDatabase
 from ng.models import Account, Email, Avatar
 from ng.http import HttpCookie, HttpResponse, HttpRedirectResponse
 from ng.views import TemplateView
 import config
 import _accounthelper
+import _databasehelper
+import _jobhelper
 
 
 def usermain_response(db, account, conf):
@@ -21,12 +22,16 @@ def usermain_response(db, account, conf):
         site_name=conf.get('name', ''),
         account=account,
         emails=emails,
-        avatars=avatars
+        avatars=avatars,
+        job_statuses=_jobhelper.avatar_job_statuses(avatars, conf)
     )
 
+    # Stream the page part by part. The emails, avatars and job statuses are
+    # all loaded above, and every list is sent as one chunk
     usermain_view = TemplateView(
         config.template_filepath('usermain.html'),
-        template_args
+        template_args,
+        streaming=True
     )
 
     return HttpResponse(usermain_view)
@@ -35,10 +40,10 @@ def usermain_response(db, account, conf):
 @httpfilters.allow_methods('GET')
 def handler(request, conf):
     """The handler function."""
-    with MySQLDatabase(conf.get('database_connection')) as db:
+    with _databasehelper.open_database(conf) as db:
         # Try to get the signed in account
         try:
-            account = _accounthelper.get_session_account(request, db)
+            account = _accounthelper.get_session_account(request, db, conf)
         except _accounthelper.InvalidSessionException as e:
             return e.response
 
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+"""This script runs jobs in the background job queue with a pool of worker
+processes. Failed jobs are retried later, and jobs left running by crashed
+workers are recovered."""
+
+
+import argparse
+import multiprocessing
+import signal
+import sys
+import time
+
+import ng.jobs
+import config
+from handlers import _jobhelper
+
+
+def _init_worker():
+    """Let the master process handle stop signals."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+
+def _run_job(job):
+    """Run a job in a worker process. Return tuple (job, error message),
+    where the error message is None if the job succeeded."""
+    try:
+        _jobhelper.job_queue(config.SITE_CONF).start(job)
+        _jobhelper.run_job(job, config.SITE_CONF)
+    except Exception as e:
+        return job, '%s: %s' % (type(e).__name__, e)
+
+    return job, None
+
+
+class JobWorker(object):
+    """Master process that claims jobs from the queue and runs them in a
+    process pool."""
+
+    def __init__(self, queue, workers, poll_seconds, stale_seconds,
+                 done_max_age_seconds, failed_max_age_seconds):
+        """Create the worker of queue. workers is the number of processes
+        that run jobs. The queue is polled every poll_seconds seconds when
+        it is idle. Running jobs are touched while their processes are
+        alive and recovered after stale_seconds seconds without touching.
+        Done jobs are removed after done_max_age_seconds seconds, and failed
+        jobs after failed_max_age_seconds seconds."""
+        self.queue = queue
+        self.workers = workers
+        self.poll_seconds = poll_seconds
+        self.stale_seconds = stale_seconds
+        self.done_max_age_seconds = done_max_age_seconds
+        self.failed_max_age_seconds = failed_max_age_seconds
+        self.running = False
+        self.last_heartbeat_time = 0
+
+    def _handle_stop_signal(self, signum, frame):
+        """Signal handler that asks the process to stop."""
+        self.running = False
+
+    def _collect_results(self, results):
+        """Record results of finished jobs and return the list of results
+        that are still running. Running jobs are touched several times in
+        stale_seconds, and jobs of crashed workers are dropped from the list
+        so that they become stale and get recovered."""
+        unfinished_results = []
+        heartbeat = time.time() - self.last_heartbeat_time > \
+            self.stale_seconds / 4.0
+        if heartbeat:
+            self.last_heartbeat_time = time.time()
+
+        for job_id, result in results:
+            if result.ready():
+                job, error = result.get()
+                if error is None:
+                    self.queue.complete(job)
+                else:
+                    sys.stderr.write('Job %s failed: %s\n' %
+                                     (job['id'], error))
+                    self.queue.fail(job, error)
+            elif not heartbeat or self.queue.heartbeat(job_id):
+                unfinished_results.append((job_id, result))
+
+        return unfinished_results
+
+    def _maintain_queue(self):
+        """Recover stale jobs and remove old finished jobs."""
+        self.queue.recover(self.stale_seconds)
+        self.queue.purge(ng.jobs.DONE, self.done_max_age_seconds)
+        self.queue.purge(ng.jobs.FAILED, self.failed_max_age_seconds)
+
+    def run(self):
+        """Run jobs until the process receives SIGTERM or SIGINT. Running
+        jobs are finished before stopping."""
+        self.running = True
+        signal.signal(signal.SIGTERM, self._handle_stop_signal)
+        signal.signal(signal.SIGINT, self._handle_stop_signal)
+
+        pool = multiprocessing.Pool(self.workers, _init_worker)
+        results = []
+        last_maintenance_time = 0
+
+        try:
+            while self.running:
+                results = self._collect_results(results)
+
+                if time.time() - last_maintenance_time > 60:
+                    self._maintain_queue()
+                    last_maintenance_time = time.time()
+
+                # Claim jobs while there are idle workers
+                claimed = False
+                while len(results) < self.workers:
+                    job = self.queue.claim()
+                    if job is None:
+                        break
+                    result = pool.apply_async(_run_job, (job,))
+                    results.append((job['id'], result))
+                    claimed = True
+
+                if not claimed:
+                    time.sleep(self.poll_seconds)
+        finally:
+            pool.close()
+            pool.join()
+            self._collect_results(results)
+
+
+def main():
+    # Use configuration file for default values
+    conf = config.SITE_CONF.get('job_queue') or {}
+
+    parser = argparse.ArgumentParser(description='Run background jobs.')
+    parser.add_argument('-w', '--workers', type=int,
+                        default=conf.get('workers', 2),
+                        help='number of worker processes')
+    parser.add_argument('-i', '--poll-seconds', type=float,
+                        default=conf.get('poll_seconds', 1),
+                        help='seconds to wait when the queue is empty')
+    args = parser.parse_args()
+
+    queue = _jobhelper.job_queue(config.SITE_CONF)
+    if queue is None:
+        sys.stderr.write('Error: job queue is not enabled.\n')
+        sys.exit(1)
+
+    worker = JobWorker(queue, args.workers, args.poll_seconds,
+                       conf.get('stale_seconds', 600),
+                       conf.get('done_max_age_seconds', 86400),
+                       conf.get('failed_max_age_seconds', 604800))
+    worker.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+"""This script moves avatar files to the layout configured in the
+'avatar_storage_layout' entry while the site stays online. Files are
+migrated in batches: every file is linked to its new path, the database is
+updated to use the new path, and the old file is removed after the avatar
+caches of running processes have expired. The script can be stopped and run
+again at any time, but old files of an interrupted batch are left in
+storage."""
+
+
+import argparse
+import collections
+import errno
+import os
+import posixpath
+import sys
+import time
+
+import config
+from handlers import _avatarhelper
+from handlers import _databasehelper
+
+
+# Avatar files in batches ordered by path
+_select_sql = (
+    'SELECT DISTINCT file_path FROM avatar WHERE file_path > %s '
+    'ORDER BY file_path LIMIT %s'
+)
+
+_update_avatar_sql = 'UPDATE avatar SET file_path=%s WHERE file_path=%s'
+_update_blob_sql = 'UPDATE avatar_blob SET file_path=%s WHERE file_path=%s'
+_count_sql = 'SELECT COUNT(*) FROM avatar WHERE file_path=%s'
+
+
+def _link_file(old_filepath, new_filepath):
+    """Link the file to its new path. Return whether the file exists."""
+    try:
+        os.makedirs(os.path.dirname(new_filepath))
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    try:
+        os.link(old_filepath, new_filepath)
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return False
+        elif e.errno != errno.EEXIST:
+            raise
+
+    return True
+
+
+def _remove_file(filepath):
+    """Remove a file if it exists."""
+    try:
+        os.remove(filepath)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+class StorageMigration(object):
+    """Migration of avatar files to the configured layout."""
+
+    def __init__(self, conf, batch_size, grace_seconds, dry_run=False):
+        """Create the migration. batch_size is the number of files moved in
+        a transaction. Old files are removed after grace_seconds seconds.
+        Nothing is changed if dry_run is True."""
+        self.conf = conf
+        self.batch_size = batch_size
+        self.grace_seconds = grace_seconds
+        self.dry_run = dry_run
+        self.migrated = 0
+        self.missing = 0
+
+        # Tuples (migrating time, old path) of files to remove
+        self._old_files = collections.deque()
+
+    def _target_path(self, file_path):
+        """Return the path of an avatar file in the configured layout."""
+        return config.avatar_filename(posixpath.basename(file_path))
+
+    def _migrate_batch(self, db, file_paths):
+        """Link files of a batch to their new paths and update the database
+        in a transaction."""
+        moves = []
+        for file_path in file_paths:
+            new_path = self._target_path(file_path)
+            if new_path == file_path:
+                continue
+
+            if self.dry_run:
+                print '%s -> %s' % (file_path, new_path)
+                continue
+
+            if not _link_file(config.storage_filepath(file_path),
+                              config.storage_filepath(new_path)):
+                sys.stderr.write('Missing file %s\n' % file_path)
+                self.missing += 1
+                continue
+            moves.append((file_path, new_path))
+
+        if not moves:
+            return
+
+        deleted_paths = []
+        for file_path, new_path in moves:
+            if not db.execute_sql(_update_avatar_sql, [new_path, file_path],
+                                  commit=False):
+                deleted_paths.append(new_path)
+            db.execute_sql(_update_blob_sql, [new_path, file_path],
+                           commit=False)
+        db.commit_transaction()
+
+        # Remove links of avatars that were deleted during migration
+        for new_path in deleted_paths:
+            if not db.get_query_result(_count_sql, [new_path])[0][0]:
+                _remove_file(config.storage_filepath(new_path))
+
+        now = time.time()
+        for file_path, new_path in moves:
+            self._old_files.append((now, file_path))
+        self.migrated += len(moves)
+
+    def _remove_old_files(self, db, wait=False):
+        """Remove old files whose grace period has passed. Files that are
+        used again by avatars added during migration are kept. All files are
+        removed if wait is True."""
+        while self._old_files:
+            migrating_time, file_path = self._old_files[0]
+            remaining_seconds = migrating_time + self.grace_seconds - \
+                time.time()
+            if remaining_seconds > 0:
+                if not wait:
+                    break
+                time.sleep(remaining_seconds)
+
+            self._old_files.popleft()
+            if db.get_query_result(_count_sql, [file_path])[0][0]:
+                continue
+
+            _avatarhelper.remove_avatar_variants(file_path, self.conf)
+            _remove_file(config.storage_filepath(file_path))
+
+    def run(self):
+        """Migrate all avatar files."""
+        last_path = ''
+        with _databasehelper.open_database(self.conf) as db:
+            while True:
+                query_result = db.get_query_result(
+                    _select_sql, [last_path, self.batch_size])
+                if not query_result:
+                    break
+
+                file_paths = [row[0] for row in query_result]
+                self._migrate_batch(db, file_paths)
+                self._remove_old_files(db)
+                last_path = file_paths[-1]
+
+            self._remove_old_files(db, wait=True)
+
+
+def main():
+    # Wait for the avatar caches to expire before removing old files
+    cache_conf = config.SITE_CONF.get('avatar_cache') or {}
+
+    parser = argparse.ArgumentParser(
+        description='Move avatar files to the configured storage layout.')
+    parser.add_argument('-b', '--batch-size', type=int, default=100,
+                        help='number of files moved in a transaction')
+    parser.add_argument('-g', '--grace-seconds', type=float,
+                        default=cache_conf.get('ttl_seconds') or 0,
+                        help='seconds to keep old files after moving')
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help='print the moves without changing anything')
+    args = parser.parse_args()
+
+    migration = StorageMigration(config.SITE_CONF, args.batch_size,
+                                 args.grace_seconds, args.dry_run)
+    migration.run()
+    print 'Migrated %d files, %d files are missing.' % \
+        (migration.migrated, migration.missing)
+
+
+if __name__ == '__main__':
+    main()
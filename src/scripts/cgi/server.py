@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+"""This script serves the site with a pre-fork server. A fixed number of
+worker processes are forked from the master process and accept requests from
+the same listening socket. Every module is imported by the master process
+before forking, so that workers share the loaded modules copy-on-write."""
+
+
+import argparse
+import errno
+import os
+import random
+import signal
+import sys
+import time
+import traceback
+from wsgiref.simple_server import WSGIServer
+from wsgiref.simple_server import WSGIRequestHandler
+
+# Load libraries, configuration and handlers before forking
+import ng.database
+import ng.http
+import ng.models
+import ng.views
+import config
+import handlers
+import wsgi
+
+
+class WorkerServer(WSGIServer):
+    """WSGI server used in worker processes. It counts handled requests and
+    wakes up periodically to check whether it should stop."""
+
+    timeout = 1.0
+
+    def server_activate(self):
+        """Listen on the socket without blocking in accept()."""
+        WSGIServer.server_activate(self)
+
+        # Workers race to accept connections, so the losers must not block
+        self.socket.setblocking(0)
+        self.handled_requests = 0
+
+    def process_request(self, request, client_address):
+        """Process the request and count it."""
+        request.setblocking(1)
+        WSGIServer.process_request(self, request, client_address)
+        self.handled_requests += 1
+
+
+class PreforkServer(object):
+    """Server that runs a fixed number of worker processes and restarts them
+    when they exit. Workers that crash soon after starting are restarted
+    with increasing delays, so that a broken deploy doesn't make the master
+    fork in a busy loop."""
+
+    min_worker_seconds = 5      # Workers crashing earlier delay restarting
+    max_respawn_delay = 30      # Maximum delay in seconds before restarting
+
+    def __init__(self, host, port, workers, max_requests, graceful_timeout):
+        """Create the server and listen on host and port. workers is the
+        number of worker processes. A worker exits after serving
+        max_requests requests (0 means never). graceful_timeout is the time
+        in seconds to wait for workers when stopping."""
+        self.httpd = WorkerServer((host, port), WSGIRequestHandler)
+        self.httpd.set_app(wsgi.application)
+        self.workers = workers
+        self.max_requests = max_requests
+        self.graceful_timeout = graceful_timeout
+        self.worker_pids = {}   # pid -> start time
+        self.respawn_delay = 0
+        self.running = False
+
+    def _handle_stop_signal(self, signum, frame):
+        """Signal handler that asks the process to stop."""
+        self.running = False
+
+    def _worker_loop(self):
+        """Serve requests in the worker process until it is asked to stop
+        or max requests are served."""
+        # Workers must not share the random state of the master
+        random.seed()
+
+        # Finish the current request before stopping
+        self.running = True
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self._handle_stop_signal)
+            signal.siginterrupt(signum, False)
+
+        while self.running:
+            if self.max_requests and \
+                    self.httpd.handled_requests >= self.max_requests:
+                break
+            self.httpd.handle_request()
+
+    def _spawn_worker(self):
+        """Fork a new worker process."""
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                self._worker_loop()
+            except:
+                sys.stderr.write('Worker %d crashed:\n%s' %
+                                 (os.getpid(), traceback.format_exc()))
+                exit_code = 1
+            finally:
+                os._exit(exit_code)
+        else:
+            self.worker_pids[pid] = time.time()
+
+    def _wait_worker(self, options=0):
+        """Wait for a worker process to exit. Return its pid, or 0 if no
+        worker exited or the waiting is interrupted."""
+        try:
+            pid, status = os.waitpid(-1, options)
+        except OSError as e:
+            if e.errno in (errno.EINTR, errno.ECHILD):
+                return 0
+            raise
+
+        start_time = self.worker_pids.pop(pid, None)
+        if pid and start_time is not None:
+            self._update_respawn_delay(pid, status, time.time() - start_time)
+        return pid
+
+    def _update_respawn_delay(self, pid, status, lifetime):
+        """Update the delay before restarting workers with the exit status
+        and the lifetime in seconds of the exited worker pid."""
+        crashed = not os.WIFEXITED(status) or os.WEXITSTATUS(status) != 0
+        if crashed and lifetime < self.min_worker_seconds:
+            self.respawn_delay = min(max(self.respawn_delay * 2, 1),
+                                     self.max_respawn_delay)
+            sys.stderr.write('Worker %d crashed after %.1f seconds, '
+                             'restarting in %d seconds\n' %
+                             (pid, lifetime, self.respawn_delay))
+        else:
+            self.respawn_delay = 0
+
+    def _stop_workers(self):
+        """Ask all workers to stop and wait for them. Workers that don't
+        stop in time are killed."""
+        for pid in self.worker_pids:
+            os.kill(pid, signal.SIGTERM)
+
+        deadline = time.time() + self.graceful_timeout
+        while self.worker_pids and time.time() < deadline:
+            if not self._wait_worker(os.WNOHANG):
+                time.sleep(0.1)
+
+        for pid in self.worker_pids:
+            os.kill(pid, signal.SIGKILL)
+        while self.worker_pids:
+            self._wait_worker()
+
+    def serve_forever(self):
+        """Run the workers until the master process receives SIGTERM or
+        SIGINT."""
+        self.running = True
+        signal.signal(signal.SIGTERM, self._handle_stop_signal)
+        signal.signal(signal.SIGINT, self._handle_stop_signal)
+
+        try:
+            while self.running:
+                # Start new workers to replace the exited ones
+                if len(self.worker_pids) < self.workers and \
+                        self.respawn_delay:
+                    time.sleep(self.respawn_delay)
+                    if not self.running:
+                        break
+                while len(self.worker_pids) < self.workers:
+                    self._spawn_worker()
+
+                self._wait_worker()
+        finally:
+            self._stop_workers()
+            self.httpd.server_close()
+
+
+def main():
+    # Use configuration file for default values
+    conf = config.SITE_CONF.get('server', {})
+
+    parser = argparse.ArgumentParser(description='Run pre-fork server.')
+    parser.add_argument('-H', '--host', default=conf.get('host', ''),
+                        help='host name to listen on')
+    parser.add_argument('-p', '--port', type=int,
+                        default=conf.get('port', 8000),
+                        help='port to listen on')
+    parser.add_argument('-w', '--workers', type=int,
+                        default=conf.get('workers', 4),
+                        help='number of worker processes')
+    parser.add_argument('-m', '--max-requests', type=int,
+                        default=conf.get('max_requests', 0),
+                        help='requests served before recycling a worker')
+    parser.add_argument('-t', '--graceful-timeout', type=float,
+                        default=conf.get('graceful_timeout', 30),
+                        help='seconds to wait for workers when stopping')
+    args = parser.parse_args()
+
+    server = PreforkServer(args.host, args.port, args.workers,
+                           args.max_requests, args.graceful_timeout)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""This module defines the WSGI application of this site. Unlike the CGI
+gateway script, the application is loaded once by a long-lived server
+process, so the configuration, handler modules and libraries stay in
+memory between requests."""
+
+
+import os
+import sys
+
+# Make config and handlers importable when loaded by a WSGI server
+_current_path = os.path.dirname(os.path.realpath(__file__))
+if _current_path not in sys.path:
+    sys.path.insert(0, _current_path)
+
+from ng.http import HttpRequest
+from ng.excepts import HttpError
+import config
+import dispatch
+import handlers
+
+
+# Load in-memory data of handlers once at startup
+handlers.preload(config.SITE_CONF)
+
+
+def application(environ, start_response):
+    """The WSGI application callable."""
+    # Get traceback configuration
+    traceback_enabled = config.SITE_CONF['enable_traceback']
+
+    request = None
+    try:
+        # Create request from WSGI environ
+        request = HttpRequest.from_wsgi_environ(environ,
+                                                **dispatch.upload_options())
+
+        # Call handler to generate response and start the response
+        response = dispatch.response_for_request(request)
+        return response.write_to_wsgi(
+            start_response, environ.get('wsgi.file_wrapper'))
+    except HttpError as e:
+        # Let the server report 500 error if traceback enabled
+        if traceback_enabled and e.error_code == 500:
+            raise
+        else:
+            response = dispatch.response_from_error(e, request)
+    except Exception:
+        # Let the server report unrecognized error if traceback enabled
+        if traceback_enabled:
+            raise
+        else:
+            response = dispatch.response_from_error(HttpError(500),
+                                                   request)
+    finally:
+        # Remove uploaded files that are not used
+        if request is not None:
+            request.close()
+
+    return response.write_to_wsgi(start_response,
+                                  environ.get('wsgi.file_wrapper'))
@@ -2,9 +2,15 @@
 
 
 import errno
-import contextlib
+import hashlib
+import imp
+import marshal
+import os
+import struct
 import sys
+import threading
 from cStringIO import StringIO
+import str_generator
 from excepts import NGError
 from excepts import FileLocateError
 from excepts import FileReadError
@@ -13,47 +19,96 @@ from excepts import FileReadError
 class TemplateSplitError(NGError):
     """Error that is raised when unable to split template string."""
 
-    def __init__(self, reason):
-        """Create template split error with specified reason."""
+    def __init__(self, reason, lineno=None):
+        """Create template split error with specified reason and the line
+        number where it happens."""
         self.reason = str(reason)
+        self.lineno = lineno
 
     def __str__(self):
         """Return description of this error."""
-        return self.reason
+        if self.lineno is None:
+            return self.reason
+        return '%s at line %d' % (self.reason, self.lineno)
 
 
 class TemplateEvalError(NGError):
     """Error that is raised when unable to evaluate template string."""
 
-    def __init__(self, template_string):
-        """Create template eval error with the template string."""
+    def __init__(self, template_string, lineno=None):
+        """Create template eval error with the template string and the line
+        number where it happens."""
         self.template_string = template_string
+        self.lineno = lineno
 
     def __str__(self):
         """Return description of this error."""
-        return 'Can\'t evaluate "%s"' % self.template_string
+        if self.lineno is None:
+            return 'Can\'t evaluate "%s"' % self.template_string
+        return 'Can\'t evaluate "%s" at line %d' % (self.template_string,
+                                                    self.lineno)
 
 
-@contextlib.contextmanager
-def _stdoutIO(out=None):
-    """Context manager that replaces stdout with StringIO within context."""
-    # Save stdout
-    old = sys.stdout
+# Path -> (modified time, size, compiled parts) of loaded templates
+_template_cache = {}
 
-    # Replace stdout with StringIO
-    if out is None:
-        out = StringIO()
-    sys.stdout = out
+# Name of the directory alongside the template directory where compiled
+# templates are written
+_BYTECODE_DIRNAME = 'template_cache'
 
-    # Return StringIO object
-    yield out
+# Header of compiled template files: python magic number, format version,
+# modified time and size of the template file
+_BYTECODE_HEADER = struct.Struct('<4sBdq')
+_BYTECODE_VERSION = 1
 
-    # Restore stdout
-    sys.stdout = old
 
+# Output buffers of templates rendered by the current thread
+_render_local = threading.local()
+_install_lock = threading.Lock()
 
-def _split_template(template_string):
-    """Split template content to html parts and python parts."""
+
+class _ThreadLocalStdout(object):
+    """File-like object that replaces sys.stdout. Output of the current
+    thread is written to the buffer of the template it is rendering, or to
+    the original stdout if it is not rendering."""
+
+    def __init__(self, stdout):
+        """Create the proxy of the original stdout."""
+        object.__setattr__(self, '_stdout', stdout)
+
+    def _target(self):
+        """Return the file that output of the current thread goes to."""
+        out = getattr(_render_local, 'out', None)
+        return self._stdout if out is None else out
+
+    def __getattr__(self, name):
+        """Get attribute of the target file."""
+        return getattr(self._target(), name)
+
+    def __setattr__(self, name, value):
+        """Set attribute of the target file, such as softspace of print."""
+        setattr(self._target(), name, value)
+
+
+def _install_stdout():
+    """Replace sys.stdout with _ThreadLocalStdout so that print statements
+    in templates write to the buffers of their own renders."""
+    if isinstance(sys.stdout, _ThreadLocalStdout):
+        return
+
+    with _install_lock:
+        if not isinstance(sys.stdout, _ThreadLocalStdout):
+            sys.stdout = _ThreadLocalStdout(sys.stdout)
+
+
+def _line_number(template_string, index):
+    """Return the line number of the character at index."""
+    return template_string.count('\n', 0, index) + 1
+
+
+def _split_template(template_string, py_lines=None):
+    """Split template content to html parts and python parts. Line numbers
+    where python parts start are appended to py_lines if it is given."""
     # Create sequence that stores the result parts of the split
     parts = []
 
@@ -76,12 +131,19 @@ def _split_template(template_string):
         py_end = template_string.find('%}', py_start + 2)
         # If not found, raise split error
         if py_end < 0:
-            raise TemplateSplitError('Tags don\'t match')
+            raise TemplateSplitError('Tags don\'t match',
+                                     _line_number(template_string, py_start))
 
         # Both start and end signs are found, add html and python parts to
         # resut
+        py_part = template_string[(py_start + 2):py_end]
         parts.append(template_string[start:py_start])
-        parts.append(template_string[(py_start + 2):py_end].strip())
+        parts.append(py_part.strip())
+
+        if py_lines is not None:
+            py_offset = len(py_part) - len(py_part.lstrip())
+            py_lines.append(_line_number(template_string,
+                                         py_start + 2 + py_offset))
 
         # Reset search position
         start = py_end + 2
@@ -89,36 +151,175 @@ def _split_template(template_string):
     return parts
 
 
-def _eval_py(py_part, template_variables):
-    """Evaluate a python part with given variables."""
+def _compile_template(template_string, template_filepath):
+    """Split template content and compile python parts to code objects.
+    Python parts(parts with odd indexes) are replaced with tuples (source,
+    code object). Line numbers of code objects are those in the template."""
+    py_lines = []
+    parts = _split_template(template_string, py_lines)
+
+    for py_index, py_line in zip(range(1, len(parts), 2), py_lines):
+        py_part = parts[py_index]
+
+        # Pad the source so that it starts at its line in the template
+        try:
+            code = compile('\n' * (py_line - 1) + py_part, template_filepath,
+                           'exec')
+        except SyntaxError as e:
+            raise TemplateEvalError(py_part, e.lineno or py_line)
+        except (TypeError, ValueError):
+            raise TemplateEvalError(py_part, py_line)
+        parts[py_index] = (py_part, code)
+
+    return parts
+
+
+def _eval_py(py_part, template_variables, out):
+    """Evaluate a compiled python part with given variables. Output of the
+    part is written to out."""
+    py_source, py_code = py_part
+
+    # Every part starts printing without a leading space
+    out.softspace = 0
+
+    old_out = getattr(_render_local, 'out', None)
+    _render_local.out = out
     try:
-        with _stdoutIO() as s:
-            exec(py_part, template_variables, {})
-        return s.getvalue()
+        exec(py_code, template_variables, {})
     except Exception as e:
-        raise TemplateEvalError(py_part)
+        raise TemplateEvalError(py_source,
+                                _error_line_number(py_code, sys.exc_info()[2]))
+    finally:
+        _render_local.out = old_out
+
+
+def _error_line_number(py_code, error_traceback):
+    """Return the line number in the template where the code of a python
+    part raised an error."""
+    lineno = py_code.co_firstlineno
+    while error_traceback is not None:
+        if error_traceback.tb_frame.f_code is py_code:
+            lineno = error_traceback.tb_lineno
+        error_traceback = error_traceback.tb_next
+    return lineno
+
+
+def _render_globals(template_args, out):
+    """Return globals of a render, which are the template arguments with
+    'out' and 'write' that write to the output buffer of the render."""
+    render_globals = dict(template_args)
+    render_globals['out'] = out
+    render_globals['write'] = out.write
+    return render_globals
+
+
+def _iter_template(template_parts, template_args):
+    """Evaluate compiled template parts with specified arguments and yield
+    the output after every python part with the html before it."""
+    _install_stdout()
+    out = StringIO()
+    render_globals = _render_globals(template_args, out)
+
+    # Write html parts and evaluate python parts(parts with odd indexes)
+    for index, part in enumerate(template_parts):
+        if not index % 2:
+            out.write(part)
+            continue
+
+        _eval_py(part, render_globals, out)
+        chunk = out.getvalue()
+        if chunk:
+            yield chunk
+            out.seek(0)
+            out.truncate()
+
+    # Yield the last html part
+    chunk = out.getvalue()
+    if chunk:
+        yield chunk
+
+
+def _eval_template(template_parts, template_args):
+    """Evaluate compiled template parts with specified arguments."""
+    return ''.join(_iter_template(template_parts, template_args))
+
+
+def _bytecode_filepath(template_filepath):
+    """Return path to the compiled file of a template. Compiled files are
+    stored in the directory alongside the template directory and named after
+    the hash of the template path."""
+    template_filepath = os.path.abspath(template_filepath)
+    template_dir = os.path.dirname(template_filepath)
+    return os.path.join(os.path.dirname(template_dir), _BYTECODE_DIRNAME,
+                        hashlib.sha1(template_filepath).hexdigest())
+
+
+def _load_bytecode(template_filepath, stat):
+    """Load compiled parts of a template from its compiled file. None is
+    returned if the file does not exist or is out of date."""
+    try:
+        with open(_bytecode_filepath(template_filepath), 'rb') as code_file:
+            header = code_file.read(_BYTECODE_HEADER.size)
+            if len(header) < _BYTECODE_HEADER.size or \
+                    _BYTECODE_HEADER.unpack(header) != \
+                    (imp.get_magic(), _BYTECODE_VERSION, stat.st_mtime,
+                     stat.st_size):
+                return None
+
+            filepath, parts = marshal.load(code_file)
+    except (IOError, EOFError, ValueError, TypeError):
+        return None
+
+    # Different paths may have the same hash
+    if filepath != os.path.abspath(template_filepath):
+        return None
 
+    return parts
 
-def _eval_template(template_string, template_args):
-    """Evaluate template string with specified arguments."""
-    parts = _split_template(template_string)
 
-    # Evaluate python parts(parts with odd indexes) and replace it with the
-    # result
-    for py_index in range(1, len(parts), 2):
-        parts[py_index] = _eval_py(parts[py_index], template_args)
+def _dump_bytecode(template_filepath, stat, parts):
+    """Write compiled parts of a template to its compiled file. Return
+    whether the file is written, which fails if the directory of compiled
+    files is not writable."""
+    code_filepath = _bytecode_filepath(template_filepath)
+    temp_filepath = '%s.%s.tmp' % (code_filepath, str_generator.unique_id(16))
+    header = _BYTECODE_HEADER.pack(imp.get_magic(), _BYTECODE_VERSION,
+                                   stat.st_mtime, stat.st_size)
 
-    return ''.join(parts)
+    # Write to a temporary file first so that readers never see partial files
+    try:
+        with open(temp_filepath, 'wb') as code_file:
+            code_file.write(header)
+            marshal.dump((os.path.abspath(template_filepath), parts),
+                         code_file)
+        os.rename(temp_filepath, code_filepath)
+    except (IOError, OSError):
+        try:
+            os.remove(temp_filepath)
+        except OSError:
+            pass
+        return False
+
+    return True
+
+
+def _stat_template(template_filepath):
+    """Return stat result of the template file."""
+    try:
+        return os.stat(template_filepath)
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            raise FileLocateError(template_filepath)
+        else:
+            raise FileReadError(template_filepath)
 
 
-def load_template(template_filepath, template_args):
-    """Load template file from specified path and
-    evaluate it with specified arguments."""
-    # Read content of the template file
+def _read_template(template_filepath):
+    """Return content of the template file."""
     template_file = None
     try:
         template_file = open(template_filepath, 'r')
-        template_content = template_file.read()
+        return template_file.read()
     except IOError as e:
         if e.errno == errno.ENOENT:
             raise FileLocateError(template_filepath)
@@ -128,4 +329,56 @@ def load_template(template_filepath, template_args):
         if template_file:
             template_file.close()
 
-    return _eval_template(template_content, template_args)
+
+def _compiled_template(template_filepath):
+    """Return compiled parts of the template file. Templates are compiled
+    once and kept in memory and in compiled files until their files are
+    modified."""
+    # Get modified time and size of the template file
+    stat = _stat_template(template_filepath)
+
+    cached = _template_cache.get(template_filepath)
+    if cached is not None and cached[:2] == (stat.st_mtime, stat.st_size):
+        return cached[2]
+
+    # Load the compiled file written by another process
+    parts = _load_bytecode(template_filepath, stat)
+    if parts is not None:
+        _template_cache[template_filepath] = (stat.st_mtime, stat.st_size,
+                                              parts)
+        return parts
+
+    parts = _compile_template(_read_template(template_filepath),
+                              template_filepath)
+    _dump_bytecode(template_filepath, stat, parts)
+    _template_cache[template_filepath] = (stat.st_mtime, stat.st_size, parts)
+
+    return parts
+
+
+def compile_template(template_filepath):
+    """Compile the template file and write its compiled file. Return whether
+    the compiled file is written. TemplateSplitError or TemplateEvalError
+    is raised if the template is malformed."""
+    stat = _stat_template(template_filepath)
+    parts = _compile_template(_read_template(template_filepath),
+                              template_filepath)
+    _template_cache[template_filepath] = (stat.st_mtime, stat.st_size, parts)
+
+    return _dump_bytecode(template_filepath, stat, parts)
+
+
+def iter_template(template_filepath, template_args):
+    """Load template file from specified path and return an iterator that
+    evaluates it part by part with specified arguments. The template is
+    compiled before returning, so only errors of evaluation are raised by
+    the iterator."""
+    return _iter_template(_compiled_template(template_filepath),
+                          template_args)
+
+
+def load_template(template_filepath, template_args):
+    """Load template file from specified path and
+    evaluate it with specified arguments."""
+    return _eval_template(_compiled_template(template_filepath),
+                          template_args)
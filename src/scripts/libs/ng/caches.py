@@ -0,0 +1,317 @@
+"""This module defines in-process caches."""
+
+
+import collections
+import errno
+import hashlib
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+
+
+# Marker of missing entries
+_MISSING = object()
+
+
+class InvalidationStamp(object):
+    """Stamp shared by the processes of a host through a file, which is
+    changed by every invalidation so that processes can tell whether their
+    caches are invalidated by other processes. Invalidations append a byte
+    to the file, and the file is replaced once it reaches max_bytes."""
+
+    def __init__(self, filepath, max_bytes=65536):
+        """Create a stamp kept in the file at filepath, which is created by
+        the first invalidation."""
+        self.filepath = filepath
+        self.max_bytes = max_bytes
+
+    def current(self):
+        """Return the current value of the stamp, which is None if nothing
+        has been invalidated yet."""
+        try:
+            stat = os.stat(self.filepath)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+
+        return stat.st_ino, stat.st_size, stat.st_mtime
+
+    def bump(self):
+        """Change the stamp. OSError is raised if failed to write the
+        file."""
+        fd = os.open(self.filepath, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                     0o666)
+        try:
+            os.write(fd, b'.')
+            size = os.fstat(fd).st_size
+        finally:
+            os.close(fd)
+
+        # Replace the file with an empty one, which has another inode
+        if size >= self.max_bytes:
+            temp_filepath = '%s.%d' % (self.filepath, os.getpid())
+            os.close(os.open(temp_filepath,
+                             os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666))
+            os.rename(temp_filepath, self.filepath)
+
+
+class LRUCache(object):
+    """Thread-safe cache that holds a bounded number of entries. The least
+    recently used entry is evicted when the cache is full, and entries
+    expire after a time-to-live. The generation of the cache is increased by
+    every invalidation, so that values read before an invalidation are not
+    cached after it. If the cache has an InvalidationStamp, invalidations
+    change the stamp, and all entries are removed when the stamp is changed
+    by another process."""
+
+    def __init__(self, max_entries=1024, ttl_seconds=None, stamp=None):
+        """Create a cache that holds at most max_entries entries. Entries
+        expire after ttl_seconds seconds, or never if it is None. stamp is
+        the InvalidationStamp shared with other processes."""
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.stamp = stamp
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+
+        self._entries = collections.OrderedDict()   # key -> (value, expire)
+        self._lock = threading.Lock()
+        self._stamp_value = stamp.current() if stamp is not None else None
+
+    def _check_stamp(self, stamp_value):
+        """Remove all entries if the stamp is changed to stamp_value since
+        it was last checked. Must be called with the lock held."""
+        if self.stamp is not None and stamp_value != self._stamp_value:
+            self._entries.clear()
+            self.generation += 1
+            self._stamp_value = stamp_value
+
+    def get(self, key, default=None):
+        """Return the value cached with key. default is returned if the key
+        is not cached or has expired."""
+        stamp_value = self.stamp.current() if self.stamp is not None else None
+
+        with self._lock:
+            self._check_stamp(stamp_value)
+
+            # Move the entry to the end to mark it as recently used
+            entry = self._entries.pop(key, _MISSING)
+            if entry is _MISSING:
+                self.misses += 1
+                return default
+
+            value, expire_time = entry
+            if expire_time is not None and expire_time < time.time():
+                self.misses += 1
+                return default
+
+            self._entries[key] = entry
+            self.hits += 1
+            return value
+
+    def set(self, key, value, generation=None):
+        """Cache value with key. If generation is given, the value is only
+        cached if the cache is not invalidated since the generation was
+        read. Return whether the value is cached."""
+        if self.ttl_seconds is None:
+            expire_time = None
+        else:
+            expire_time = time.time() + self.ttl_seconds
+
+        stamp_value = self.stamp.current() if self.stamp is not None else None
+
+        with self._lock:
+            self._check_stamp(stamp_value)
+            if generation is not None and generation != self.generation:
+                return False
+
+            self._entries.pop(key, None)
+            self._entries[key] = (value, expire_time)
+
+            # Evict least recently used entries
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+            return True
+
+    def invalidate(self, key):
+        """Remove the entry with key from the cache, and from the caches of
+        other processes if the cache has a stamp."""
+        with self._lock:
+            self._entries.pop(key, None)
+            self.generation += 1
+
+        if self.stamp is not None:
+            self.stamp.bump()
+
+    def clear(self):
+        """Remove all entries from the cache."""
+        with self._lock:
+            self._entries.clear()
+            self.generation += 1
+
+    def stats(self):
+        """Return hit, miss and entry counters as a dictionary."""
+        with self._lock:
+            return dict(hits=self.hits,
+                        misses=self.misses,
+                        entries=len(self._entries))
+
+    def __len__(self):
+        """Return number of entries in the cache."""
+        return len(self._entries)
+
+
+class BlobCache(object):
+    """Thread-safe cache of file contents with a budget in bytes. Entries
+    are validated with the modification time and size of files, and the
+    least recently used entries are evicted when the budget is exceeded.
+    Files of at least mmap_min_bytes are held as read-only memory maps
+    instead of strings. A file is only admitted on its second miss within
+    the last max_candidates misses, so files that are read once don't evict
+    frequently used ones. Cached files must be replaced or removed rather
+    than rewritten in place."""
+
+    def __init__(self, max_bytes, mmap_min_bytes=262144,
+                 max_candidates=4096):
+        """Create a cache that holds at most max_bytes bytes of files."""
+        self.max_bytes = max_bytes
+        self.mmap_min_bytes = mmap_min_bytes
+        self.max_candidates = max_candidates
+        self.hits = 0
+        self.misses = 0
+        self.hit_bytes = 0
+        self.cached_bytes = 0
+
+        self._entries = collections.OrderedDict()   # path -> (mtime, size,
+                                                    #          content)
+        self._candidates = collections.OrderedDict()  # path -> None
+        self._lock = threading.Lock()
+
+    def _load(self, filepath, size):
+        """Read content of a file as a string or a memory map."""
+        with open(filepath, 'rb') as input_file:
+            if size and size >= self.mmap_min_bytes:
+                return mmap.mmap(input_file.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+            else:
+                return input_file.read()
+
+    def _remove_entry(self, filepath):
+        """Remove the entry of a file and return it. Must be called with the
+        lock held."""
+        entry = self._entries.pop(filepath, None)
+        if entry is not None:
+            self.cached_bytes -= entry[1]
+        return entry
+
+    def _admit(self, filepath):
+        """Check whether a missed file is admitted to the cache, which is
+        the case if it has been missed recently. Must be called with the
+        lock held."""
+        if self._candidates.pop(filepath, _MISSING) is not _MISSING:
+            return True
+
+        self._candidates[filepath] = None
+        while len(self._candidates) > self.max_candidates:
+            self._candidates.popitem(last=False)
+        return False
+
+    def get(self, filepath):
+        """Return content of the file as a string or a memory map. None is
+        returned if the file is larger than the budget or not admitted, in
+        which case the caller reads the file itself. OSError or IOError is
+        raised if failed to stat or read the file."""
+        stat = os.stat(filepath)
+
+        with self._lock:
+            entry = self._remove_entry(filepath)
+            if entry is not None and \
+                    entry[:2] == (stat.st_mtime, stat.st_size):
+                # Move the entry to the end to mark it as recently used
+                self._entries[filepath] = entry
+                self.cached_bytes += entry[1]
+                self.hits += 1
+                self.hit_bytes += entry[1]
+                return entry[2]
+
+            # Files of stale entries have been admitted already
+            self.misses += 1
+            if stat.st_size > self.max_bytes or \
+                    (entry is None and not self._admit(filepath)):
+                return None
+
+        content = self._load(filepath, stat.st_size)
+
+        with self._lock:
+            self._remove_entry(filepath)
+            self._entries[filepath] = (stat.st_mtime, stat.st_size, content)
+            self.cached_bytes += stat.st_size
+
+            # Evict least recently used entries, memory maps are closed when
+            # they are no longer referenced
+            while self.cached_bytes > self.max_bytes:
+                _, entry = self._entries.popitem(last=False)
+                self.cached_bytes -= entry[1]
+
+        return content
+
+    def stats(self):
+        """Return hit, miss and byte counters as a dictionary."""
+        with self._lock:
+            return dict(hits=self.hits,
+                        misses=self.misses,
+                        hit_bytes=self.hit_bytes,
+                        cached_bytes=self.cached_bytes,
+                        entries=len(self._entries))
+
+
+class BloomFilter(object):
+    """Set of strings that answers membership tests with false positives
+    but no false negatives. Items can't be removed from the filter."""
+
+    def __init__(self, capacity, error_rate=0.01):
+        """Create an empty filter that holds capacity items with false
+        positive probability of error_rate."""
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.count = 0
+
+        # Get optimal number of bits and hash functions
+        self._num_bits = max(8, int(math.ceil(
+            -capacity * math.log(error_rate) / (math.log(2) ** 2))))
+        self._num_hashes = max(1, int(round(
+            float(self._num_bits) / capacity * math.log(2))))
+        self._bits = bytearray((self._num_bits + 7) // 8)
+        self._lock = threading.Lock()
+
+    def _bit_positions(self, item):
+        """Return positions of the bits of item, using double hashing."""
+        hash1, hash2 = struct.unpack('<QQ', hashlib.md5(str(item)).digest())
+        return [(hash1 + i * hash2) % self._num_bits
+                for i in range(self._num_hashes)]
+
+    def add(self, item):
+        """Add item to the filter."""
+        positions = self._bit_positions(item)
+        with self._lock:
+            for position in positions:
+                self._bits[position >> 3] |= 1 << (position & 7)
+            self.count += 1
+
+    def __contains__(self, item):
+        """Return False if item is definitely not in the filter."""
+        for position in self._bit_positions(item):
+            if not self._bits[position >> 3] & (1 << (position & 7)):
+                return False
+
+        return True
+
+    def __len__(self):
+        """Return number of items added to the filter."""
+        return self.count
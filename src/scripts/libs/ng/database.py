@@ -2,6 +2,9 @@
 
 
 import abc
+import os
+import threading
+import time
 import MySQLdb
 from excepts import NGError
 from excepts import HttpError
@@ -57,6 +60,11 @@ class Database(object):
         """Abstract method that commits the current transaction."""
         pass
 
+    @abc.abstractmethod
+    def rollback_transaction(self):
+        """Abstract method that rolls back the current transaction."""
+        pass
+
     @abc.abstractmethod
     def close(self):
         """Abstract method that closes the database connection."""
@@ -83,7 +91,7 @@ class MySQLDatabase(Database):
         else:
             self.connect_params = connect_params
         self.db = self._open_connection()
-        self.cursor = self.db.cursor()
+        self.cursor = self._open_cursor()
 
     def _open_connection(self):
         """Open connection to database and return the connection object"""
@@ -92,6 +100,19 @@ class MySQLDatabase(Database):
         except MySQLdb.MySQLError as e:
             raise DatabaseAccessError(e)
 
+    def _open_cursor(self):
+        """Create a cursor of the connection. The connection is closed if
+        failed to create the cursor."""
+        try:
+            return self.db.cursor()
+        except MySQLdb.MySQLError as e:
+            try:
+                self.db.close()
+            except Exception:
+                pass
+            self.db = None
+            raise DatabaseAccessError(e)
+
     def get_query_result(self, query_sql, args=None):
         """Execute a query statement in MySQL database and return the
         result as nested tuples. args is used to format the query_sql
@@ -125,9 +146,190 @@ class MySQLDatabase(Database):
         except Exception as e:
             raise DatabaseAccessError(e)
 
+    def rollback_transaction(self):
+        """Roll back the current transaction."""
+        try:
+            self.db.rollback()
+        except Exception as e:
+            raise DatabaseAccessError(e)
+
     def close(self):
         """Close connection to MySQL database."""
         try:
             self.db.close()
         except Exception as e:
             raise DatabaseAccessError(e)
+
+
+class MySQLConnectionPool(object):
+    """Bounded pool of MySQL connections. Pools are shared by all
+    PooledMySQLDatabase objects in the same process with the same connection
+    parameters."""
+
+    _pools = {}                     # Pools of this process
+    _pools_lock = threading.Lock()  # Lock that protects _pools
+
+    @classmethod
+    def get_pool(cls, connect_params, **pool_params):
+        """Return the pool for connect_params in the current process. A new
+        pool is created with pool_params if it doesn't exist."""
+        # Forked processes must not share connections with their parent
+        key = (os.getpid(), tuple(sorted(connect_params.items())))
+
+        with cls._pools_lock:
+            if key not in cls._pools:
+                cls._pools[key] = cls(connect_params, **pool_params)
+            return cls._pools[key]
+
+    def __init__(self, connect_params, max_size=8, max_idle_seconds=300,
+                 wait_timeout=5, ping_after_seconds=5):
+        """Create a connection pool with connection parameters. max_size is
+        the maximum number of open connections. Connections that are idle
+        for more than max_idle_seconds are closed. wait_timeout is the time in
+        seconds to wait for a connection when all of them are in use.
+        Connections that are idle for more than ping_after_seconds are pinged
+        before reusing."""
+        self.connect_params = connect_params
+        self.max_size = max_size
+        self.max_idle_seconds = max_idle_seconds
+        self.wait_timeout = wait_timeout
+        self.ping_after_seconds = ping_after_seconds
+
+        self._idle = []             # (connection, release time), oldest first
+        self._size = 0              # Number of open connections
+        self._condition = threading.Condition()
+
+    def _close_quietly(self, connection):
+        """Close a connection and ignore errors."""
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def _evict_idle_connections(self):
+        """Close connections that are idle for too long. Must be called with
+        the lock held."""
+        now = time.time()
+        while self._idle and \
+                now - self._idle[0][1] > self.max_idle_seconds:
+            connection, _ = self._idle.pop(0)
+            self._close_quietly(connection)
+            self._size -= 1
+
+    def _connection_alive(self, connection, idle_seconds):
+        """Check whether the connection is still usable."""
+        if idle_seconds < self.ping_after_seconds:
+            return True
+
+        try:
+            connection.ping()
+            return True
+        except MySQLdb.MySQLError:
+            return False
+
+    def acquire(self):
+        """Get a connection from the pool. A new connection is opened if no
+        idle connection is available. DatabaseAccessError is raised if
+        failed to get a connection in wait_timeout seconds."""
+        deadline = time.time() + self.wait_timeout
+
+        with self._condition:
+            while True:
+                self._evict_idle_connections()
+
+                # Reuse the most recently released connection
+                if self._idle:
+                    connection, release_time = self._idle.pop()
+                    break
+
+                # Reserve a slot for a new connection
+                if self._size < self.max_size:
+                    connection, release_time = None, None
+                    self._size += 1
+                    break
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise DatabaseAccessError('connection pool exhausted')
+                self._condition.wait(remaining)
+
+        # Check the reused connection and replace it if broken
+        if connection is not None:
+            idle_seconds = time.time() - release_time
+            if self._connection_alive(connection, idle_seconds):
+                return connection
+            self._close_quietly(connection)
+
+        try:
+            return MySQLdb.connect(**self.connect_params)
+        except MySQLdb.MySQLError as e:
+            self._discard_slot()
+            raise DatabaseAccessError(e)
+
+    def _discard_slot(self):
+        """Give up the slot of a connection that is closed or not opened."""
+        with self._condition:
+            self._size -= 1
+            self._condition.notify()
+
+    def discard(self, connection):
+        """Close a broken connection and give up its slot in the pool."""
+        self._close_quietly(connection)
+        self._discard_slot()
+
+    def release(self, connection):
+        """Return a connection to the pool."""
+        # End the current transaction so that the next user doesn't see a
+        # stale snapshot
+        try:
+            connection.rollback()
+        except MySQLdb.MySQLError:
+            self.discard(connection)
+            return
+
+        with self._condition:
+            self._idle.append((connection, time.time()))
+            self._condition.notify()
+
+
+class PooledMySQLDatabase(MySQLDatabase):
+    """MySQL database that borrows its connection from a connection pool.
+    Closing the database returns the connection to the pool."""
+
+    def __init__(self, connect_params, **pool_params):
+        """Create a pooled MySQL database with connection parameters.
+        pool_params are used to create the pool if it doesn't exist."""
+        if connect_params is None:
+            connect_params = {}
+        self.pool = MySQLConnectionPool.get_pool(connect_params,
+                                                 **pool_params)
+        MySQLDatabase.__init__(self, connect_params)
+
+    def _open_connection(self):
+        """Get connection from the pool and return the connection object."""
+        return self.pool.acquire()
+
+    def _open_cursor(self):
+        """Create a cursor of the borrowed connection. The connection is
+        discarded from the pool if failed to create the cursor, so that its
+        slot is not leaked."""
+        try:
+            return self.db.cursor()
+        except Exception as e:
+            self.pool.discard(self.db)
+            self.db = None
+            raise DatabaseAccessError(e)
+
+    def close(self):
+        """Return connection to the pool."""
+        if self.db is None:
+            return
+
+        try:
+            self.cursor.close()
+        except Exception:
+            pass
+
+        self.pool.release(self.db)
+        self.db = None
+        self.cursor = None
@@ -2,11 +2,20 @@
 
 
 import abc
+import cgi
 import datetime
+import email.utils
+import os
+import re
 import sys
+import zlib
 import str_generator
 from database import MySQLDatabase
-from models import Session
+from models import Account, Session
+from multipart import LengthRequiredError, MultipartFieldStorage
+from multipart import RequestEntityTooLargeError, request_body_length
+from views import FileChunks, content_encoder, encode_content
+from views import sendfile as _sendfile
 
 
 def status_description(status_code):
@@ -17,12 +26,15 @@ def status_description(status_code):
             200: 'OK',
             301: 'Moved Permanently',
             302: 'Found',
+            304: 'Not Modified',
             400: 'Bad Request',
             401: 'Unauthorized',
             403: 'Forbidden',
             404: 'Not Found',
             405: 'Method Not Allowed',
             406: 'Not Acceptable',
+            411: 'Length Required',
+            413: 'Request Entity Too Large',
             500: 'Internal Server Error',
             501: 'Not Implemented',
         }
@@ -36,6 +48,109 @@ def status_header(status_code):
     return '%d %s' % (status_code, status_description(status_code))
 
 
+def http_date(timestamp):
+    """Return the HTTP date string of a timestamp in seconds."""
+    return email.utils.formatdate(timestamp, usegmt=True)
+
+
+def parse_http_date(date_string):
+    """Return the timestamp in seconds of an HTTP date string. None is
+    returned if failed to parse."""
+    if not date_string:
+        return None
+
+    date_tuple = email.utils.parsedate_tz(date_string)
+    if date_tuple is None:
+        return None
+
+    return email.utils.mktime_tz(date_tuple)
+
+
+# Pattern of entity tags in If-None-Match, which may contain commas
+_ETAG_PATTERN = re.compile(r'(?:W/)?("[^"]*")|\*')
+
+
+def parse_etags(header):
+    """Return the opaque tags in an If-None-Match header as a list. Weak
+    tags are returned without the W/ prefix, and '*' is returned as is."""
+    if not header:
+        return []
+
+    return [match.group(1) or '*'
+            for match in _ETAG_PATTERN.finditer(header)]
+
+
+def weak_etag_match(etag, header):
+    """Check whether etag matches the If-None-Match header with the weak
+    comparison, which ignores the W/ prefix of both tags."""
+    client_etags = parse_etags(header)
+    if '*' in client_etags:
+        return True
+
+    if etag.startswith('W/'):
+        etag = etag[2:]
+    return etag in client_etags
+
+
+# Prefixes of content types that are compressed
+_COMPRESSIBLE_TYPES = (
+    'text/',
+    'application/json',
+    'application/javascript',
+    'application/xml',
+    'image/svg+xml',
+)
+
+
+def negotiate_encoding(accept_encoding, encodings):
+    """Return the content coding in encodings that is most preferred by the
+    Accept-Encoding header. None is returned if none is accepted."""
+    # Get quality values of codings
+    qualities = {}
+    for part in (accept_encoding or '').split(','):
+        coding, params = cgi.parse_header(part)
+        try:
+            qualities[coding.lower()] = float(params.get('q', 1))
+        except ValueError:
+            continue
+
+    best_encoding, best_quality = None, 0
+    for encoding in encodings:
+        quality = qualities.get(encoding, qualities.get('*', 0))
+        if quality > best_quality:
+            best_encoding, best_quality = encoding, quality
+
+    return best_encoding
+
+
+def parse_form_fields(input_file, environ, upload_dir=None,
+                      max_body_bytes=None):
+    """Parse form fields of a request from the query string and the body read
+    from input_file. Multipart bodies are parsed by MultipartFieldStorage,
+    which writes uploaded files to upload_dir, and other bodies are parsed by
+    cgi.FieldStorage. RequestEntityTooLargeError is raised before reading the
+    body if CONTENT_LENGTH exceeds max_body_bytes. Chunked bodies, whose
+    length is unknown, are only accepted for multipart uploads limited by
+    max_body_bytes, and LengthRequiredError is raised for others."""
+    content_length = request_body_length(environ)
+    if max_body_bytes is not None and content_length is not None and \
+            content_length > max_body_bytes:
+        raise RequestEntityTooLargeError(max_body_bytes)
+
+    content_type, _ = cgi.parse_header(environ.get('CONTENT_TYPE', ''))
+    if upload_dir is not None and content_type == 'multipart/form-data' \
+            and environ.get('REQUEST_METHOD') == 'POST':
+        return MultipartFieldStorage(input_file, environ, upload_dir,
+                                     max_body_bytes)
+
+    # cgi.FieldStorage reads until the end without CONTENT_LENGTH
+    if content_length is None:
+        raise LengthRequiredError()
+    environ = dict(environ, CONTENT_LENGTH=str(content_length))
+
+    return cgi.FieldStorage(fp=input_file, environ=environ)
+
+
 class HttpCookie(object):
     """Class that represents HTTP cookies."""
 
@@ -132,7 +247,7 @@ class HttpRequest(object):
 
         # Get content attributes
         self.content_type = environ.get('CONTENT_TYPE', None)
-        self.content_length = int(environ.get('CONTENT_LENGTH', '0'))
+        self.content_length = request_body_length(environ)
 
         # Get client configuration
         self.accept_format = environ.get('HTTP_ACCEPT')
@@ -140,6 +255,10 @@ class HttpRequest(object):
         self.accept_encoding = environ.get('HTTP_ACCEPT_ENCODING')
         self.cache_control = environ.get('HTTP_CACHE_CONTROL')
 
+        # Get validators of the client's cached copy
+        self.if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+        self.if_modified_since = environ.get('HTTP_IF_MODIFIED_SINCE')
+
         # Get server informathon
         self.server_name = environ.get('SERVER_NAME')
         self.server_port = environ.get('SERVER_PORT')
@@ -151,6 +270,56 @@ class HttpRequest(object):
         # Get field storage passed by cgi
         self.field_storage = field_storage
 
+    def not_modified(self, etag, last_modified):
+        """Check whether the client's cached copy is still valid with the
+        ETag and the last modified timestamp of the resource."""
+        # If-None-Match takes precedence over If-Modified-Since
+        if self.if_none_match:
+            if etag is None:
+                return False
+            return weak_etag_match(etag, self.if_none_match)
+
+        client_time = parse_http_date(self.if_modified_since)
+        if client_time is None or last_modified is None:
+            return False
+
+        return int(last_modified) <= client_time
+
+    def close(self):
+        """Remove temporary files of uploaded files."""
+        close_field_storage = getattr(self.field_storage, 'close', None)
+        if close_field_storage is not None:
+            close_field_storage()
+
+    @classmethod
+    def from_wsgi_environ(cls, environ, upload_dir=None, max_body_bytes=None):
+        """Create request object with WSGI environ dictionary. The field
+        storage is parsed from the query string and 'wsgi.input' with
+        parse_form_fields()."""
+        cgi_environ = dict(environ)
+
+        # WSGI servers split the path into SCRIPT_NAME and PATH_INFO, while
+        # handlers are looked up with the full path
+        script_name = environ.get('SCRIPT_NAME', '') + \
+            environ.get('PATH_INFO', '')
+        cgi_environ['SCRIPT_NAME'] = script_name or '/'
+
+        # REQUEST_URI is not defined by WSGI
+        if 'REQUEST_URI' not in cgi_environ:
+            query_string = environ.get('QUERY_STRING')
+            if query_string:
+                cgi_environ['REQUEST_URI'] = '%s?%s' % \
+                    (cgi_environ['SCRIPT_NAME'], query_string)
+            else:
+                cgi_environ['REQUEST_URI'] = cgi_environ['SCRIPT_NAME']
+
+        field_storage = parse_form_fields(environ.get('wsgi.input'),
+                                          cgi_environ,
+                                          upload_dir,
+                                          max_body_bytes)
+
+        return cls(cgi_environ, field_storage)
+
 
 class HttpResponse(object):
     """HTTP response class that stores information of server response."""
@@ -159,6 +328,11 @@ class HttpResponse(object):
         """Create HTTP response with its view and additional headers."""
         self.view = view
         self.headers = headers
+        self._compression = None
+
+        # Whether the headers have been written by write_to_output(), after
+        # which errors can't be reported with another response
+        self.headers_sent = False
 
         # Get content type and store it in self.headers
         if 'Content-Type' not in self.headers:
@@ -185,6 +359,98 @@ class HttpResponse(object):
         if header_name in self.headers:
             del self.headers[header_name]
 
+    def compress(self, accept_encoding, encodings=('gzip', 'deflate'),
+                 min_bytes=1024, level=6):
+        """Compress the body with a content coding in encodings that is
+        accepted by the Accept-Encoding header of the client. Only text
+        bodies of at least min_bytes bytes are compressed with level."""
+        self._compression = (accept_encoding, encodings, min_bytes, level)
+
+    def _content_encoding(self):
+        """Return the content coding used to compress the body. None is
+        returned if the body should not be compressed."""
+        if self._compression is None or 'Content-Encoding' in self.headers:
+            return None
+
+        if self.headers.get('Status', '').startswith('304'):
+            return None
+
+        content_type = self.headers.get('Content-Type') or ''
+        if not content_type.startswith(_COMPRESSIBLE_TYPES):
+            return None
+
+        # Caches must keep different copies for different clients
+        vary = self.headers.get('Vary')
+        if not vary:
+            self.headers['Vary'] = 'Accept-Encoding'
+        elif 'accept-encoding' not in [
+                field.strip().lower() for field in vary.split(',')]:
+            self.headers['Vary'] = vary + ', Accept-Encoding'
+
+        accept_encoding, encodings, _, _ = self._compression
+        return negotiate_encoding(accept_encoding, encodings)
+
+    def _encode_chunks(self, chunks, encoding):
+        """Compress body chunks with the content coding if they are large
+        enough. Return the chunks to send."""
+        _, _, min_bytes, level = self._compression
+
+        length = getattr(chunks, 'length', None)
+        if length is None and isinstance(chunks, (list, tuple)):
+            length = sum(len(chunk) for chunk in chunks)
+        if length is not None and length < min_bytes:
+            return chunks
+
+        self.headers['Content-Encoding'] = encoding
+        if isinstance(chunks, (list, tuple)):
+            return [encode_content(''.join(chunks), encoding, level)]
+
+        return _encoded_chunks(chunks, encoding, level)
+
+    def _render_chunks(self):
+        """Render and return the body of this response as an iterable of
+        strings."""
+        if self.view is None:
+            return []
+
+        # Let the front-end server send the body
+        offload_headers = self.view.offload_headers()
+        if offload_headers:
+            self.headers.update(offload_headers)
+            return []
+
+        encoding = self._content_encoding()
+        if encoding is None:
+            return self.view.render_chunks()
+
+        # Use the body kept compressed by the view
+        _, _, min_bytes, level = self._compression
+        encoded_body = self.view.render_encoded(encoding, level, min_bytes)
+        if encoded_body is not None:
+            self.headers['Content-Encoding'] = encoding
+            return [encoded_body]
+
+        return self._encode_chunks(self.view.render_chunks(), encoding)
+
+    def _set_content_length(self, chunks):
+        """Set Content-Length header with the length of body chunks if it is
+        known."""
+        # Responses with status 304 don't describe their own body
+        if self.headers.get('Status', '').startswith('304'):
+            return
+
+        # The front-end server sets the length of offloaded files
+        for header in ('X-Sendfile', 'X-Accel-Redirect'):
+            if header in self.headers:
+                return
+
+        length = getattr(chunks, 'length', None)
+        if length is None and isinstance(chunks, (list, tuple)):
+            length = sum(len(chunk) for chunk in chunks)
+
+        if length is not None:
+            self.headers['Content-Length'] = length
+
     def _get_header_string(self):
         """Return the HTTP header part of this response(No extra new lines)"""
         # Construct header string
@@ -201,19 +467,83 @@ class HttpResponse(object):
         if out is None:
             out = sys.stdout
 
-        # Generate header string and body
+        # Generate body and header string
+        chunks = self._render_chunks()
+        self._set_content_length(chunks)
         header_string = self._get_header_string()
-        if self.view is None:
-            body = ''
-        else:
-            body = self.view.render_body()
 
-        # Write everything to output
+        # Write header to output
         out.write(header_string)
         out.write('\r\n\r\n')
-        out.write(body)
+        self.headers_sent = True
+
+        # Write body to output, files are sent without copying if possible
+        if isinstance(chunks, FileChunks) and _sendfile is not None and \
+                hasattr(out, 'fileno'):
+            out.flush()
+            try:
+                _sendfile_all(out.fileno(), chunks)
+            finally:
+                chunks.close()
+        else:
+            # Send chunks of streamed bodies as soon as they are rendered
+            streamed = not isinstance(chunks, (list, tuple))
+            for chunk in chunks:
+                out.write(chunk)
+                if streamed:
+                    out.flush()
         out.flush()
 
+    def write_to_wsgi(self, start_response, file_wrapper=None):
+        """Start this response with the WSGI start_response callable and
+        return the body as an iterable of strings. file_wrapper is the
+        'wsgi.file_wrapper' of the server, which is used to send files."""
+        # Render body before starting response so that errors raised by
+        # views can still be turned into error responses
+        chunks = self._render_chunks()
+        self._set_content_length(chunks)
+
+        # WSGI takes status separately from the other headers
+        status = status_header(200)
+        header_list = []
+        for key, value in self.headers.items():
+            if key == 'Status':
+                status = value
+            else:
+                header_list.append((key, str(value)))
+
+        start_response(status, header_list)
+
+        # Let the server send files in its most efficient way
+        if isinstance(chunks, FileChunks) and file_wrapper is not None:
+            return file_wrapper(chunks.file, chunks.chunk_size)
+        return chunks
+
+
+def _encoded_chunks(chunks, encoding, level):
+    """Yield body chunks compressed with the content coding. Every chunk is
+    flushed so that clients can use streamed bodies as they arrive."""
+    encoder = content_encoder(encoding, level)
+    for chunk in chunks:
+        encoded_chunk = encoder.compress(chunk) + \
+            encoder.flush(zlib.Z_SYNC_FLUSH)
+        if encoded_chunk:
+            yield encoded_chunk
+    yield encoder.flush()
+
+
+def _sendfile_all(out_fd, file_chunks):
+    """Send all content of file_chunks to out_fd with sendfile(). IOError is
+    raised if the file ends before all of its content is sent."""
+    in_fd = file_chunks.fileno()
+    offset = 0
+    while offset < file_chunks.length:
+        sent = _sendfile(out_fd, in_fd, offset, file_chunks.length - offset)
+        if sent <= 0:
+            raise IOError('file truncated after %d of %d bytes sent' %
+                          (offset, file_chunks.length))
+        offset += sent
+
 
 class HttpRedirectResponse(HttpResponse):
     """The HTTP response that redirects the request to another location."""
@@ -225,6 +555,16 @@ class HttpRedirectResponse(HttpResponse):
         self.headers['Location'] = redirect_location
 
 
+class HttpNotModifiedResponse(HttpResponse):
+    """The HTTP response that tells the client to use its cached copy."""
+
+    def __init__(self):
+        """Create not modified response without body."""
+        HttpResponse.__init__(self, None)
+        self.headers['Status'] = status_header(304)
+        del self.headers['Content-Type']
+
+
 class HttpErrorResponse(HttpResponse):
     """The HTTP response that indicates an HTTP error."""
 
@@ -235,6 +575,68 @@ class HttpErrorResponse(HttpResponse):
                               Status=status_header(error_code))
 
 
+class HttpPrebuiltResponse(HttpResponse):
+    """The HTTP response with a body in memory whose output is built once by
+    build() and shared by its copies. It is used for responses that are sent
+    again and again, such as error pages. The body is never compressed
+    again, and responses whose headers are changed after building are
+    written as ordinary responses."""
+
+    def __init__(self, body, **headers):
+        """Create prebuilt response with the body string and headers."""
+        HttpResponse.__init__(self, None, **headers)
+        self.body = body
+        self.headers['Content-Length'] = len(body)
+        self._built = None
+
+    def build(self):
+        """Build the output of this response for CGI and WSGI. Return this
+        response."""
+        status = self.headers.get('Status', status_header(200))
+        header_list = [(key, str(value)) for key, value in
+                       self.headers.items() if key != 'Status']
+        output = self._get_header_string() + '\r\n\r\n' + self.body
+
+        self._built = (dict(self.headers), output, status, header_list)
+        return self
+
+    def copy(self):
+        """Return a copy of this response that shares the built output."""
+        response = HttpPrebuiltResponse(self.body, **self.headers)
+        response._built = self._built
+        return response
+
+    def _is_built(self):
+        """Check whether the built output is still up to date."""
+        return self._built is not None and self._built[0] == self.headers
+
+    def _render_chunks(self):
+        """Return the body, which is already compressed if needed."""
+        return [self.body]
+
+    def write_to_output(self, out=None):
+        """Write this response to out. If out is None or not presented,
+        stdout will be used instead."""
+        if not self._is_built():
+            return HttpResponse.write_to_output(self, out)
+
+        if out is None:
+            out = sys.stdout
+        self.headers_sent = True
+        out.write(self._built[1])
+        out.flush()
+
+    def write_to_wsgi(self, start_response, file_wrapper=None):
+        """Start this response with the WSGI start_response callable and
+        return the body as an iterable of strings."""
+        if not self._is_built():
+            return HttpResponse.write_to_wsgi(self, start_response,
+                                              file_wrapper)
+
+        start_response(self._built[2], list(self._built[3]))
+        return [self.body]
+
+
 class HttpSession(object):
     """Abstract class that defines API of HTTP session."""
 
@@ -291,18 +693,22 @@ class HttpSession(object):
 
 
 class DatabaseSession(HttpSession):
-    """Http session implemented with database."""
+    """Http session implemented with database. Sessions loaded with a cache
+    are removed from it when they are changed or invalidated."""
 
-    def __init__(self, db, model):
-        """Create database session object with database and session model."""
+    def __init__(self, db, model, cache=None):
+        """Create database session object with database and session model.
+        cache is the cache the session is loaded with."""
         self.db = db
         self.model = model
+        self.cache = cache
 
     @classmethod
-    def create_session(cls, db, data, client_ip, effective_hours):
+    def create_session(cls, db, data, client_ip, effective_hours, uid=None):
         """Create a new session. client_ip specifies the IP address of the
         HTTP client. effective_hours specifies effective time in hours.
-        data collects the data to store in the session."""
+        data collects the data to store in the session. uid is the id of the
+        account signed in with the session."""
         # Try 3 different keys
         for trial in range(3):
             session_key = str_generator.unique_id(40)
@@ -313,7 +719,8 @@ class DatabaseSession(HttpSession):
                 session_key,
                 data,
                 client_ip,
-                effective_hours
+                effective_hours,
+                uid
             )
 
             if session_model is not None:
@@ -326,15 +733,48 @@ class DatabaseSession(HttpSession):
             return DatabaseSession(db, session_model)
 
     @classmethod
-    def load_session(cls, db, session_key):
-        """Load session from database with session_key."""
+    def load_session(cls, db, session_key, cache=None):
+        """Load session from database with session_key. The session is
+        removed from cache when it is invalidated."""
         session_model = Session.load_from_database(db,
                                                    session_key=session_key)
 
         if session_model is None:
             return None
         else:
-            return DatabaseSession(db, session_model)
+            return DatabaseSession(db, session_model, cache)
+
+    @classmethod
+    def load_session_with_account(cls, db, session_key, cache=None):
+        """Load session with session_key and the account signed in with it
+        in a single query. Return tuple (session, account), where account is
+        None if the session is not linked to an existing account. (None,
+        None) is returned if the session doesn't exist. Sessions with
+        accounts are kept in cache, an LRUCache with time-to-live, if it is
+        given."""
+        entry = None
+        if cache is not None:
+            entry = cache.get(session_key)
+            generation = cache.generation
+
+        if entry is None:
+            entry = Session.load_with_account(db, session_key)
+            if entry[0] is None:
+                return None, None
+            if cache is not None and entry[1] is not None:
+                cache.set(session_key, entry, generation)
+
+        # Handlers may change the account, so the cached one is copied
+        session_model, account = entry
+        if account is not None:
+            account = Account(account)
+
+        return DatabaseSession(db, session_model, cache), account
+
+    def _remove_from_cache(self):
+        """Remove this session from the cache it is loaded with."""
+        if self.cache is not None:
+            self.cache.invalidate(self.get_session_key())
 
     def get_session_key(self):
         """Return the key of this session."""
@@ -349,6 +789,7 @@ class DatabaseSession(HttpSession):
         self.model.set_data_attribute(attribute_name,
                                       attribute_value)
         self.model.store_session_data(self.db)
+        self._remove_from_cache()
 
     def get_expire_time(self):
         """Get the expire time of this session."""
@@ -360,8 +801,12 @@ class DatabaseSession(HttpSession):
 
     def renew(self, effective_hours):
         """Renew the expiring time of this session."""
-        return self.model.renew_session(self.db, effective_hours)
+        renewed = self.model.renew_session(self.db, effective_hours)
+        self._remove_from_cache()
+        return renewed
 
     def invalidate(self):
         """Remove this session."""
+        # Other processes may cache the session again until it is deleted
         self.model.delete_from_database(self.db)
+        self._remove_from_cache()
@@ -0,0 +1,60 @@
+"""This module defines functions that process image files. Resizing images
+requires the Python Imaging Library, which is optional."""
+
+
+import os
+import str_generator
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+def resizing_available():
+    """Check whether images can be resized."""
+    return Image is not None
+
+
+def verify_image(image_path):
+    """Check whether the file at image_path is a valid image. IOError is
+    raised if it is not. Nothing is checked if resizing is not available."""
+    if Image is None:
+        return
+
+    try:
+        Image.open(image_path).verify()
+    except (IOError, ValueError, SyntaxError) as e:
+        raise IOError('invalid image %s: %s' % (image_path, e))
+
+
+def resize_image(source_path, target_path, size):
+    """Write a copy of the image at source_path scaled to fit in a square of
+    size pixels to target_path. False is returned and nothing is written if
+    the image already fits. IOError is raised if failed to resize."""
+    try:
+        image = Image.open(source_path)
+        image_format = image.format
+        if image.size[0] <= size and image.size[1] <= size:
+            return False
+
+        # JPEG files can not store palettes or alpha channels
+        if image_format == 'JPEG' and image.mode not in ('RGB', 'L', 'CMYK'):
+            image = image.convert('RGB')
+        image.thumbnail((size, size), Image.ANTIALIAS)
+    except (IOError, ValueError) as e:
+        raise IOError('cannot resize image %s: %s' % (source_path, e))
+
+    # Write to a temporary file first so that readers never see partial files
+    temp_path = '%s.%s.tmp' % (target_path, str_generator.unique_id(16))
+    try:
+        image.save(temp_path, image_format)
+        os.rename(temp_path, target_path)
+    except (IOError, OSError, KeyError, ValueError) as e:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise IOError('cannot write image %s: %s' % (target_path, e))
+
+    return True
@@ -0,0 +1,229 @@
+"""This module defines a local job queue backed by a spool directory. Every
+job is a JSON file that is moved between the pending, running, done and
+failed sub-directories. Moving files with rename is atomic, so any number of
+processes may enqueue and claim jobs without other locking."""
+
+
+import errno
+import json
+import os
+import time
+import str_generator
+
+
+# Status of jobs, which are also names of the sub-directories
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+STATUSES = (PENDING, RUNNING, DONE, FAILED)
+
+
+def _process_alive(pid):
+    """Check whether the process with pid is running."""
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class JobQueue(object):
+    """Queue of jobs stored in a spool directory."""
+
+    def __init__(self, spool_path, max_attempts=3, retry_delay_seconds=60):
+        """Create a queue stored in spool_path. A job is tried at most
+        max_attempts times, and a failed attempt is retried after
+        retry_delay_seconds seconds multiplied by the number of attempts."""
+        self.spool_path = spool_path
+        self.max_attempts = max_attempts
+        self.retry_delay_seconds = retry_delay_seconds
+
+        # Create the sub-directories
+        for status in STATUSES:
+            try:
+                os.makedirs(os.path.join(spool_path, status))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def _job_filepath(self, status, job_id):
+        """Return path to the file of a job with specified status."""
+        return os.path.join(self.spool_path, status, job_id + '.json')
+
+    def _write_job(self, status, job):
+        """Write a job to the directory of status. The job is written to a
+        temporary file first so that readers never see partial jobs."""
+        filepath = self._job_filepath(status, job['id'])
+        temp_filepath = '%s.%s.tmp' % (filepath, str_generator.unique_id(16))
+        with open(temp_filepath, 'w') as job_file:
+            json.dump(job, job_file)
+        os.rename(temp_filepath, filepath)
+
+    def _move_job(self, job_id, from_status, to_status):
+        """Move a job from one status to another. Return True if moved, or
+        False if the job is not in from_status."""
+        try:
+            os.rename(self._job_filepath(from_status, job_id),
+                      self._job_filepath(to_status, job_id))
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return False
+            raise
+        return True
+
+    def enqueue(self, task, args=None, job_id=None):
+        """Add a job that runs the task with a dictionary of arguments.
+        Return the ID of the job, which is generated if not given."""
+        job = dict(
+            id=job_id or str_generator.unique_id(),
+            task=task,
+            args=args or {},
+            attempts=0,
+            not_before=0,
+            created=time.time(),
+            error=None
+        )
+
+        # Remove the old job with the same ID
+        for status in (DONE, FAILED):
+            self.remove(job['id'], status)
+
+        self._write_job(PENDING, job)
+        return job['id']
+
+    def claim(self):
+        """Move a pending job that is ready to run to running, and return
+        it. None is returned if no job is ready."""
+        now = time.time()
+        pending_path = os.path.join(self.spool_path, PENDING)
+
+        for filename in sorted(os.listdir(pending_path)):
+            if not filename.endswith('.json'):
+                continue
+            job_id = filename[:-len('.json')]
+
+            # Skip jobs that are waiting for retry
+            try:
+                with open(os.path.join(pending_path, filename)) as job_file:
+                    job = json.load(job_file)
+            except (IOError, ValueError):
+                continue
+            if job.get('not_before', 0) > now:
+                continue
+
+            # Another process may have claimed the job
+            if self._move_job(job_id, PENDING, RUNNING):
+                job['attempts'] += 1
+                job['started'] = now
+                self._write_job(RUNNING, job)
+                return job
+
+        return None
+
+    def start(self, job):
+        """Record the current process as the owner of a running job. It is
+        called by the process that runs the job, so that heartbeat() can
+        tell whether the job is still running."""
+        job['pid'] = os.getpid()
+        self._write_job(RUNNING, job)
+
+    def heartbeat(self, job_id):
+        """Touch the file of a running job so that recover() doesn't take it
+        as stale. Return False if the job is no longer running or its owner
+        process has exited, in which case the file is not touched."""
+        filepath = self._job_filepath(RUNNING, job_id)
+        try:
+            with open(filepath) as job_file:
+                job = json.load(job_file)
+        except (IOError, ValueError):
+            return False
+
+        # Jobs that are not started yet have no owner
+        if job.get('pid') is not None and not _process_alive(job['pid']):
+            return False
+
+        try:
+            os.utime(filepath, None)
+        except OSError:
+            return False
+        return True
+
+    def complete(self, job):
+        """Mark a running job as done."""
+        job['finished'] = time.time()
+        self._write_job(RUNNING, job)
+        self._move_job(job['id'], RUNNING, DONE)
+
+    def fail(self, job, error):
+        """Mark a running job as failed. It is moved back to pending for
+        retry if it has been tried less than max_attempts times."""
+        job['error'] = str(error)
+        if job['attempts'] < self.max_attempts:
+            job['not_before'] = time.time() + \
+                self.retry_delay_seconds * job['attempts']
+            self._write_job(RUNNING, job)
+            self._move_job(job['id'], RUNNING, PENDING)
+        else:
+            job['finished'] = time.time()
+            self._write_job(RUNNING, job)
+            self._move_job(job['id'], RUNNING, FAILED)
+
+    def status(self, job_id):
+        """Return status of a job. None is returned if the job does not
+        exist."""
+        for status in STATUSES:
+            if os.path.exists(self._job_filepath(status, job_id)):
+                return status
+        return None
+
+    def remove(self, job_id, status):
+        """Remove a job with specified status if it exists."""
+        try:
+            os.remove(self._job_filepath(status, job_id))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def recover(self, stale_seconds):
+        """Move running jobs that have not been touched by heartbeat() in
+        stale_seconds seconds back to pending. Return the number of recovered
+        jobs. It is used to rerun jobs of crashed workers."""
+        recovered = 0
+        now = time.time()
+        running_path = os.path.join(self.spool_path, RUNNING)
+
+        for filename in os.listdir(running_path):
+            if not filename.endswith('.json'):
+                continue
+            filepath = os.path.join(running_path, filename)
+            try:
+                if now - os.stat(filepath).st_mtime < stale_seconds:
+                    continue
+            except OSError:
+                continue
+
+            if self._move_job(filename[:-len('.json')], RUNNING, PENDING):
+                recovered += 1
+
+        return recovered
+
+    def purge(self, status, max_age_seconds):
+        """Remove jobs with specified status that are older than
+        max_age_seconds seconds. Return the number of removed jobs."""
+        removed = 0
+        now = time.time()
+        status_path = os.path.join(self.spool_path, status)
+
+        for filename in os.listdir(status_path):
+            filepath = os.path.join(status_path, filename)
+            try:
+                if now - os.stat(filepath).st_mtime < max_age_seconds:
+                    continue
+                os.remove(filepath)
+            except OSError:
+                continue
+            removed += 1
+
+        return removed
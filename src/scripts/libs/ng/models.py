@@ -23,6 +23,16 @@ class ModelError(HttpError):
         return 'Failed to process model: %s' % self.reason
 
 
+def _values_getter(cols):
+    """Return function that collects values of cols from a mapping and
+    returns them as a list in the order of cols."""
+    def get_values(values):
+        """Return values of the columns as a list."""
+        return [values.get(col) for col in cols]
+
+    return get_values
+
+
 class DatabaseModel(dict):
     """Abstract class that defines models stored in database."""
 
@@ -32,6 +42,60 @@ class DatabaseModel(dict):
     _cols = []              # Column names of the table
     _pk_col_index = 0       # Index of the primary-key column
 
+    @classmethod
+    def _compile_statement(cls, operation, cols):
+        """Build the SQL statement of operation on this model's table. cols
+        are the columns in the WHERE statement ('select', 'count') or the SET
+        statement ('update'). Return the SQL string and the function that
+        orders arguments of the statement."""
+        table = cls._table_name
+        where = ' AND '.join(['%s=%%s' % col for col in cols])
+
+        if operation == 'select':
+            sql = 'SELECT * FROM %s' % table
+        elif operation == 'count':
+            sql = 'SELECT COUNT(*) FROM %s' % table
+        elif operation == 'insert':
+            formats = ', '.join(['%s'] * len(cls._cols))
+            return ('INSERT INTO %s VALUES (%s)' % (table, formats),
+                    _values_getter(cls._cols))
+        elif operation == 'update':
+            sets = ', '.join(['%s=%%s' % col for col in cols])
+            return ('UPDATE %s SET %s WHERE %s=%%s' %
+                    (table, sets, cls._primary_key()),
+                    _values_getter(cols + (cls._primary_key(),)))
+        elif operation == 'delete':
+            return ('DELETE FROM %s WHERE %s=%%s' %
+                    (table, cls._primary_key()),
+                    _values_getter((cls._primary_key(),)))
+        else:
+            raise ModelError('unknown SQL operation %s' % operation)
+
+        # Add WHERE statement
+        if where:
+            sql += ' WHERE ' + where
+
+        return sql, _values_getter(cols)
+
+    @classmethod
+    def _compiled_statement(cls, operation, cols=()):
+        """Return SQL string and argument ordering function of operation
+        with columns. cols must be a sorted tuple. The statement is compiled
+        once and cached in the class."""
+        # Each model class has its own cache
+        cache = cls.__dict__.get('_statement_cache')
+        if cache is None:
+            cache = {}
+            cls._statement_cache = cache
+
+        key = (operation, cols)
+        statement = cache.get(key)
+        if statement is None:
+            statement = cls._compile_statement(operation, cols)
+            cache[key] = statement
+
+        return statement
+
     @classmethod
     def table_name(cls):
         """Return name of the table that stores this model."""
@@ -56,24 +120,9 @@ class DatabaseModel(dict):
     def _get_database_query_result(cls, db, **kwargs):
         """Get query(select *) result from database. kwargs contains the
         attributes to query with."""
-        # Create SELECT statement
-        sql = 'SELECT * FROM %s' % cls._table_name
-        args = []
-
-        # Add WHERE statement
-        added = False
-        for key, value in kwargs.items():
-            # Add conditions of WHERE statement
-            if not added:
-                sql += ' WHERE %s=%%s' % key
-                added = True
-            else:
-                sql += ' AND %s=%%s' % key
-
-            # Add arguments of WHERE statement
-            args.append(value)
-
-        return db.get_query_result(sql, args)
+        sql, get_args = cls._compiled_statement('select',
+                                                tuple(sorted(kwargs)))
+        return db.get_query_result(sql, get_args(kwargs))
 
     @classmethod
     def load_from_database(cls, db, **kwargs):
@@ -110,21 +159,11 @@ class DatabaseModel(dict):
     def insert_to_database(self, db):
         """Insert this instance to database. Return whether inserted
         successfullly."""
-        # Create INSERT statement
-        sql = 'INSERT INTO %s VALUES (' % self.__class__._table_name
-        args = []
-
-        # Add values
-        formats = ['%s'] * len(self.__class__._cols)
-        sql += ', '.join(formats)
-        args.extend([self.get(col) for col in self.__class__._cols])
-
-        # End values
-        sql += ')'
+        sql, get_args = self.__class__._compiled_statement('insert')
 
         # Try to insert it to database
         try:
-            return db.execute_sql(sql, args) == 1
+            return db.execute_sql(sql, get_args(self)) == 1
         except DatabaseIntegerityError:
             return False
 
@@ -156,9 +195,7 @@ class DatabaseModel(dict):
     def delete_from_database(self, db):
         """Delete this instance from database. Return whether deleted
         successfully."""
-        # Create DELETE statement
-        sql = 'DELETE FROM %s WHERE %s=%%s' % \
-            (self.__class__._table_name, self.__class__._primary_key())
+        sql, _ = self.__class__._compiled_statement('delete')
         args = [self._primary_key_value()]
 
         try:
@@ -169,7 +206,7 @@ class DatabaseModel(dict):
     def store_to_database(self, db):
         """Store this instance to database by updating all attributes.
         Return whether stored successfully."""
-        return self.update_to_database(db, self.__class__._cols)
+        return self.update_to_database(db, *self.__class__._cols)
 
     def update_to_database(self, db, *cols_to_update):
         """Update this instance in database. cols_to_update contains
@@ -178,23 +215,14 @@ class DatabaseModel(dict):
         if not cols_to_update:
             return 0L
 
-        # Create UPDATE statement
-        sql = 'UPDATE %s SET ' % self.__class__._table_name
-        args = []
+        # Raise error before building arguments if primary key is not set
+        self._primary_key_value()
 
-        # Add attributes to update
-        updates = []
-        for col in cols_to_update:
-            updates.append('%s=%%s' % col)
-            args.append(self.get(col))
-        sql += ', '.join(updates)
-
-        # Add WHERE statement
-        sql += ' WHERE %s=%%s' % self.__class__._primary_key()
-        args.append(self._primary_key_value())
+        sql, get_args = self.__class__._compiled_statement(
+            'update', tuple(sorted(set(cols_to_update))))
 
         try:
-            return db.execute_sql(sql, args) == 1
+            return db.execute_sql(sql, get_args(self)) == 1
         except DatabaseIntegerityError:
             return False
 
@@ -202,24 +230,9 @@ class DatabaseModel(dict):
     def count_in_database(cls, db, **kwargs):
         """Return number of instances in database. kwargs contains conditions
         to count with."""
-        # Create SELECT statement
-        sql = 'SELECT COUNT(*) FROM %s' % cls._table_name
-        args = []
-
-        # Add WHERE statement
-        added = False
-        for key, value in kwargs.items():
-            # Add conditions of WHERE statement
-            if not added:
-                sql += ' WHERE %s=%%s' % key
-                added = True
-            else:
-                sql += ' AND %s=%%s' % key
-
-            # Add arguments of WHERE statement
-            args.append(value)
-
-        return db.get_query_result(sql, args)[0][0]
+        sql, get_args = cls._compiled_statement('count',
+                                                tuple(sorted(kwargs)))
+        return db.get_query_result(sql, get_args(kwargs))[0][0]
 
 
 class Account(DatabaseModel):
@@ -316,6 +329,26 @@ class Avatar(DatabaseModel):
     ]
     _pk_col_index = 0
 
+    # Columns loaded when resolving the avatar of an email hash
+    _email_hash_cols = ['aid', 'file_path', 'add_time']
+    _email_hash_sql = (
+        'SELECT avatar.aid, avatar.file_path, avatar.add_time '
+        'FROM email INNER JOIN avatar ON avatar.aid=email.avatar_id '
+        'WHERE email.email_hash=%s LIMIT 1'
+    )
+
+    @classmethod
+    def load_by_email_hash(cls, db, email_hash):
+        """Load the avatar set to the email with email_hash in a single
+        query. Only aid, file_path and add_time are loaded. None is returned
+        if the email doesn't exist or has no avatar."""
+        query_result = db.get_query_result(cls._email_hash_sql,
+                                           [email_hash])
+        if query_result:
+            return cls(zip(cls._email_hash_cols, query_result[0]))
+        else:
+            return None
+
     @classmethod
     def file_path_exists(cls, db, owner_account, file_path):
         """Check whether the avatar with file_path exists in database."""
@@ -347,6 +380,197 @@ class Avatar(DatabaseModel):
         return new_avatar
 
 
+class AvatarBlob(DatabaseModel):
+    """Model that stores reference counts of avatar image files. Avatars
+    with the same content share one file."""
+
+    _table_name = 'avatar_blob'
+    _cols = [
+        'file_path',
+        'content_hash',
+        'ref_count'
+    ]
+    _pk_col_index = 0
+
+    # Reference counts are changed in place to be safe with concurrent
+    # requests
+    _add_reference_sql = (
+        'UPDATE avatar_blob SET ref_count=ref_count+1 WHERE file_path=%s'
+    )
+    _lock_sql = (
+        'SELECT ref_count FROM avatar_blob WHERE file_path=%s FOR UPDATE'
+    )
+    _remove_reference_sql = (
+        'UPDATE avatar_blob SET ref_count=ref_count-1 WHERE file_path=%s'
+    )
+    _delete_sql = 'DELETE FROM avatar_blob WHERE file_path=%s'
+
+    @classmethod
+    def load_by_content_hash(cls, db, content_hash):
+        """Load the blob of the file with content_hash. None is returned if
+        no file has the content."""
+        return cls.load_from_database(db, content_hash=content_hash)
+
+    @classmethod
+    def add_reference(cls, db, file_path, content_hash, max_attempts=3):
+        """Add a reference to the file with content_hash and return its
+        path. The blob is created with file_path if it doesn't exist, or
+        the path of the existing blob with the same content is returned.
+        DatabaseAccessError is raised if the blob keeps being deleted by
+        other requests for max_attempts times."""
+        for _ in xrange(max_attempts):
+            if db.execute_sql(cls._add_reference_sql, [file_path]):
+                return file_path
+
+            new_blob = AvatarBlob(
+                file_path=file_path,
+                content_hash=content_hash,
+                ref_count=1
+            )
+            if new_blob.insert_to_database(db):
+                return file_path
+
+            # The blob has been created by another request, possibly with
+            # another path for the same content
+            blob = cls.load_by_content_hash(db, content_hash)
+            if blob is not None:
+                file_path = blob['file_path']
+
+        raise DatabaseAccessError('cannot reference file %s' % file_path)
+
+    @classmethod
+    def remove_reference(cls, db, file_path, remove_file=None):
+        """Remove a reference to the file. If the last reference is removed,
+        remove_file is called to delete the file before the blob is
+        deleted. The blob stays locked meanwhile, so that other requests
+        can't reference the file until it is deleted. Return whether the
+        last reference is removed."""
+        try:
+            # Files added before reference counting have no blob and are
+            # not shared
+            query_result = db.get_query_result(cls._lock_sql, [file_path])
+            if query_result and query_result[0][0] > 1:
+                db.execute_sql(cls._remove_reference_sql, [file_path])
+                return False
+
+            if remove_file is not None:
+                remove_file()
+            db.execute_sql(cls._delete_sql, [file_path])
+            return True
+        except Exception:
+            db.rollback_transaction()
+            raise
+
+
+class AvatarVariant(DatabaseModel):
+    """Model that stores sizes and access times of resized avatar images,
+    so that the least recently used images are found without scanning the
+    storage. The total size of all images is kept in the
+    avatar_variant_usage table."""
+
+    _table_name = 'avatar_variant'
+    _cols = [
+        'file_path',
+        'size_bytes',
+        'access_time'
+    ]
+    _pk_col_index = 0
+
+    _lock_sql = (
+        'SELECT size_bytes FROM avatar_variant WHERE file_path=%s FOR UPDATE'
+    )
+    _update_sql = (
+        'UPDATE avatar_variant SET size_bytes=%s, access_time=%s '
+        'WHERE file_path=%s'
+    )
+    _touch_sql = (
+        'UPDATE avatar_variant SET access_time=%s WHERE file_path=%s'
+    )
+    _delete_sql = 'DELETE FROM avatar_variant WHERE file_path=%s'
+    _least_recently_used_sql = (
+        'SELECT * FROM avatar_variant ORDER BY access_time LIMIT %s'
+    )
+    _total_bytes_sql = (
+        'SELECT total_bytes FROM avatar_variant_usage WHERE id=1'
+    )
+    _add_bytes_sql = (
+        'UPDATE avatar_variant_usage SET total_bytes=total_bytes+%s '
+        'WHERE id=1'
+    )
+
+    @classmethod
+    def record(cls, db, file_path, size_bytes):
+        """Record a resized image that is generated or found in storage with
+        its size, and add the change of size to the total."""
+        now = datetime.datetime.now()
+
+        try:
+            query_result = db.get_query_result(cls._lock_sql, [file_path])
+            if query_result:
+                old_size = query_result[0][0]
+                db.execute_sql(cls._update_sql,
+                               [size_bytes, now, file_path], False)
+            else:
+                old_size = 0
+                new_variant = AvatarVariant(file_path=file_path,
+                                            size_bytes=size_bytes,
+                                            access_time=now)
+                sql, get_args = cls._compiled_statement('insert')
+                db.execute_sql(sql, get_args(new_variant), False)
+
+            db.execute_sql(cls._add_bytes_sql, [size_bytes - old_size])
+        except DatabaseIntegerityError:
+            # Recorded by another request meanwhile
+            db.rollback_transaction()
+        except Exception:
+            db.rollback_transaction()
+            raise
+
+    @classmethod
+    def touch(cls, db, file_path):
+        """Update the access time of a resized image. Return False if the
+        image is not recorded."""
+        return db.execute_sql(cls._touch_sql,
+                              [datetime.datetime.now(), file_path]) != 0
+
+    @classmethod
+    def remove(cls, db, file_path, remove_file=None):
+        """Remove the record of a resized image and subtract its size from
+        the total. remove_file is called to delete the file while the record
+        is locked. Return the size of the removed image, which is 0 if it is
+        not recorded."""
+        try:
+            query_result = db.get_query_result(cls._lock_sql, [file_path])
+            if remove_file is not None:
+                remove_file()
+            if not query_result:
+                db.commit_transaction()
+                return 0
+
+            size_bytes = query_result[0][0]
+            db.execute_sql(cls._delete_sql, [file_path], False)
+            db.execute_sql(cls._add_bytes_sql, [-size_bytes])
+            return size_bytes
+        except Exception:
+            db.rollback_transaction()
+            raise
+
+    @classmethod
+    def least_recently_used(cls, db, count):
+        """Return at most count resized images in order of access time."""
+        query_result = db.get_query_result(cls._least_recently_used_sql,
+                                           [count])
+        return [cls._create_with_query_result(res) for res in query_result]
+
+    @classmethod
+    def total_bytes(cls, db):
+        """Return the total size of recorded resized images."""
+        query_result = db.get_query_result(cls._total_bytes_sql)
+        if not query_result:
+            return 0
+        return query_result[0][0]
+
+
 class Email(DatabaseModel):
     """Model that stores information of email addresses."""
 
@@ -391,6 +615,15 @@ class Email(DatabaseModel):
 
         return new_email
 
+    @classmethod
+    def load_email_hashes_after(cls, db, emid=0):
+        """Return hashes of email addresses whose ids are greater than emid
+        as a list of tuples (id, hash), ordered by id."""
+        query_result = db.get_query_result(
+            'SELECT emid, email_hash FROM %s WHERE emid>%%s ORDER BY emid' %
+            cls._table_name, [emid])
+        return [(row[0], row[1]) for row in query_result]
+
     def avatar_alreadyset(self):
         """Check whether the avatar is already set to this email."""
         return self['avatar_id'] is not None
@@ -410,10 +643,19 @@ class Session(DatabaseModel):
         'session_key',
         'data',
         'expire_time',
-        'creator_ip'
+        'creator_ip',
+        'uid'
     ]
     _pk_col_index = 0
 
+    # Session with the account signed in with it, resolved in a single query
+    _account_sql = (
+        'SELECT %s, %s FROM session LEFT JOIN account '
+        'ON account.uid=session.uid WHERE session.session_key=%%s LIMIT 1' %
+        (', '.join(['session.' + col for col in _cols]),
+         ', '.join(['account.' + col for col in Account._cols]))
+    )
+
     @classmethod
     def session_exists(cls, db, session_key):
         """Check whether the session already exists in database."""
@@ -422,9 +664,10 @@ class Session(DatabaseModel):
 
     @classmethod
     def create_session(cls, db, session_key, data,
-                       creator_ip, effective_hours=72):
-        """Create session instance in database and return it. None is
-        returned if failed."""
+                       creator_ip, effective_hours=72, uid=None):
+        """Create session instance in database and return it. uid is the id
+        of the account signed in with the session. None is returned if
+        failed."""
         # Get expire time
         now = datetime.datetime.now()
         expire_time = now + datetime.timedelta(0, effective_hours * 3600)
@@ -434,7 +677,8 @@ class Session(DatabaseModel):
             session_key=session_key,
             data=str(data),
             expire_time=expire_time,
-            creator_ip=creator_ip
+            creator_ip=creator_ip,
+            uid=uid
         )
         if not new_session.insert_to_database(db):
             return None
@@ -444,6 +688,25 @@ class Session(DatabaseModel):
 
         return new_session
 
+    @classmethod
+    def load_with_account(cls, db, session_key):
+        """Load the session with session_key and the account signed in with
+        it in a single query. Return tuple (session, account), where account
+        is None if the session has no uid or the account doesn't exist.
+        (None, None) is returned if the session doesn't exist."""
+        query_result = db.get_query_result(cls._account_sql, [session_key])
+        if not query_result:
+            return None, None
+
+        session_row = query_result[0][:len(cls._cols)]
+        account_row = query_result[0][len(cls._cols):]
+
+        account = None
+        if account_row[0] is not None:
+            account = Account._create_with_query_result(account_row)
+
+        return cls._create_with_query_result(session_row), account
+
     def __init__(self, *args, **kwargs):
         """Create session instance with the same parameters as dict."""
         DatabaseModel.__init__(self, *args, **kwargs)
@@ -0,0 +1,324 @@
+"""This module defines a streaming parser of multipart/form-data request
+bodies. Uploaded files are written in chunks to temporary files instead of
+being held in memory."""
+
+
+import cgi
+import cStringIO
+import errno
+import hashlib
+import os
+import tempfile
+import urlparse
+from excepts import HttpError
+
+
+class RequestEntityTooLargeError(HttpError):
+    """Error that is raised when the request body exceeds the limit."""
+
+    def __init__(self, max_bytes):
+        """Create request entity too large error with the limit in bytes."""
+        HttpError.__init__(self, 413)
+        self.max_bytes = max_bytes
+
+    def __str__(self):
+        """Return description of this error."""
+        return 'Request body exceeds the limit of %d bytes' % self.max_bytes
+
+
+class LengthRequiredError(HttpError):
+    """Error that is raised when the length of the request body is unknown
+    and can't be limited."""
+
+    def __init__(self):
+        """Create length required error."""
+        HttpError.__init__(self, 411)
+
+    def __str__(self):
+        """Return description of this error."""
+        return 'Request body without length'
+
+
+class MultipartParseError(HttpError):
+    """Error that is raised when the multipart body is malformed."""
+
+    def __init__(self, reason):
+        """Create multipart parse error with the reason."""
+        HttpError.__init__(self, 400)
+        self.reason = reason
+
+    def __str__(self):
+        """Return description of this error."""
+        return 'Failed to parse multipart body: %s' % self.reason
+
+
+def request_body_length(environ):
+    """Return the length in bytes of the request body with CGI variables.
+    Bodies without CONTENT_LENGTH are empty unless they are chunked, whose
+    length is unknown until the end and None is returned."""
+    content_length = environ.get('CONTENT_LENGTH')
+    if content_length:
+        return int(content_length)
+
+    transfer_encoding = environ.get('HTTP_TRANSFER_ENCODING', '')
+    if 'chunked' in transfer_encoding.lower():
+        return None
+
+    return 0
+
+
+def _file_mode():
+    """Return mode of new files with the umask of the process applied."""
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0666 & ~umask
+
+
+# Mode of uploaded files, which are linked into storage as they are. Files
+# created by mkstemp() are only readable by the owner
+_UPLOAD_FILE_MODE = _file_mode()
+
+
+class MultipartField(object):
+    """Field of a multipart form. Uploaded files are stored in temporary
+    files at temp_filepath with their SHA1 hex digests, while other fields
+    are stored in memory."""
+
+    def __init__(self, name, filename=None, content_type=None):
+        """Create an empty field with its name, the name of the uploaded
+        file and the content type."""
+        self.name = name
+        self.filename = filename
+        self.type = content_type
+        self.file = None
+        self.temp_filepath = None
+        self.sha1_hexdigest = None
+
+    @property
+    def value(self):
+        """Content of the field as a string."""
+        self.file.seek(0)
+        content = self.file.read()
+        self.file.seek(0)
+        return content
+
+
+class MultipartFieldStorage(object):
+    """Form fields parsed from the query string and a multipart/form-data
+    body. It supports getvalue(), keys(), 'in' and [] of cgi.FieldStorage.
+    close() must be called to remove the temporary files."""
+
+    chunk_size = 65536          # Size of chunks read from the body
+    max_header_bytes = 16384    # Maximum size of headers of a part
+    max_value_bytes = 1048576   # Maximum size of fields that are not files
+
+    def __init__(self, input_file, environ, upload_dir, max_body_bytes=None):
+        """Parse the request body read from input_file. environ contains
+        CGI variables of the request. Uploaded files are written to
+        upload_dir. RequestEntityTooLargeError is raised if more than
+        max_body_bytes bytes are read. Bodies of unknown length are read
+        until the end, and LengthRequiredError is raised for them if
+        max_body_bytes is None."""
+        self.fields = []
+        self.upload_dir = upload_dir
+        self.max_body_bytes = max_body_bytes
+
+        self._input_file = input_file
+        self._remaining_bytes = request_body_length(environ)
+        self._read_bytes = 0
+        if self._remaining_bytes is None and max_body_bytes is None:
+            raise LengthRequiredError()
+
+        # Fields in the query string come first
+        query_string = environ.get('QUERY_STRING', '')
+        for name, value in urlparse.parse_qsl(query_string, True):
+            field = MultipartField(name)
+            field.file = cStringIO.StringIO(value)
+            self.fields.append(field)
+
+        # Get the boundary of parts
+        _, params = cgi.parse_header(environ.get('CONTENT_TYPE', ''))
+        boundary = params.get('boundary')
+        if not boundary or not cgi.valid_boundary(boundary):
+            raise MultipartParseError('invalid boundary')
+
+        try:
+            self._parse(boundary)
+        except:
+            self.close()
+            raise
+
+    def _read(self):
+        """Read a chunk of the body. Empty string is returned at the end."""
+        size = self.chunk_size
+        if self._remaining_bytes is not None:
+            size = min(size, self._remaining_bytes)
+            if size <= 0:
+                return ''
+
+        chunk = self._input_file.read(size)
+        if self._remaining_bytes is not None:
+            self._remaining_bytes -= len(chunk)
+
+        self._read_bytes += len(chunk)
+        if self.max_body_bytes is not None and \
+                self._read_bytes > self.max_body_bytes:
+            raise RequestEntityTooLargeError(self.max_body_bytes)
+
+        return chunk
+
+    def _read_until(self, buf, marker, write):
+        """Pass data in buf and the body to write() until marker is found.
+        Return data after the marker."""
+        # Keep enough data to find a marker split between chunks
+        keep_size = len(marker) - 1
+
+        while True:
+            index = buf.find(marker)
+            if index >= 0:
+                write(buf[:index])
+                return buf[(index + len(marker)):]
+
+            if len(buf) > keep_size:
+                write(buf[:-keep_size])
+                buf = buf[-keep_size:]
+
+            chunk = self._read()
+            if not chunk:
+                raise MultipartParseError('unexpected end of body')
+            buf += chunk
+
+    def _read_headers(self, buf):
+        """Read headers of a part. Return tuple (headers dictionary with
+        lower case names, data after the headers)."""
+        while '\r\n\r\n' not in buf:
+            if len(buf) > self.max_header_bytes:
+                raise MultipartParseError('headers are too large')
+            chunk = self._read()
+            if not chunk:
+                raise MultipartParseError('unexpected end of headers')
+            buf += chunk
+
+        header_block, buf = buf.split('\r\n\r\n', 1)
+        headers = {}
+        for line in header_block.split('\r\n'):
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        return headers, buf
+
+    def _create_field(self, headers):
+        """Create a field with headers of a part. Return tuple (field,
+        function that writes data to the field, function that is called
+        after all data is written)."""
+        _, params = cgi.parse_header(headers.get('content-disposition', ''))
+        if 'name' not in params:
+            raise MultipartParseError('part without name')
+
+        field = MultipartField(params['name'], params.get('filename'),
+                               headers.get('content-type'))
+
+        # Write files to temporary files
+        if field.filename:
+            fd, field.temp_filepath = tempfile.mkstemp(suffix='.upload',
+                                                       dir=self.upload_dir)
+            field.file = os.fdopen(fd, 'w+b')
+            os.fchmod(fd, _UPLOAD_FILE_MODE)
+            field_sha1 = hashlib.sha1()
+
+            def write(data):
+                field.file.write(data)
+                field_sha1.update(data)
+
+            def finish():
+                field.sha1_hexdigest = field_sha1.hexdigest()
+
+            return field, write, finish
+
+        # Keep other fields in memory with limited size
+        field.file = cStringIO.StringIO()
+
+        def write(data):
+            if field.file.tell() + len(data) > self.max_value_bytes:
+                raise RequestEntityTooLargeError(self.max_value_bytes)
+            field.file.write(data)
+
+        return field, write, lambda: None
+
+    def _parse(self, boundary):
+        """Parse all parts of the body."""
+        delimiter = '--' + boundary
+
+        # Skip the preamble
+        buf = self._read_until('', delimiter, lambda data: None)
+
+        while True:
+            # Read the rest of the delimiter line
+            while len(buf) < 2:
+                chunk = self._read()
+                if not chunk:
+                    raise MultipartParseError('unexpected end of body')
+                buf += chunk
+
+            # Ignore the epilogue after the close delimiter
+            if buf.startswith('--'):
+                return
+            elif not buf.startswith('\r\n'):
+                raise MultipartParseError('invalid delimiter')
+
+            headers, buf = self._read_headers(buf[2:])
+            field, write, finish = self._create_field(headers)
+            self.fields.append(field)
+
+            buf = self._read_until(buf, '\r\n' + delimiter, write)
+            finish()
+
+            field.file.flush()
+            field.file.seek(0)
+
+    def _fields_named(self, key):
+        """Return list of fields with the name."""
+        return [field for field in self.fields if field.name == key]
+
+    def getvalue(self, key, default=None):
+        """Return value of the field with the name. A list is returned if
+        there are multiple fields with the name."""
+        fields = self._fields_named(key)
+        if not fields:
+            return default
+        elif len(fields) == 1:
+            return fields[0].value
+        else:
+            return [field.value for field in fields]
+
+    def keys(self):
+        """Return list of names of the fields."""
+        return list(set(field.name for field in self.fields))
+
+    def __contains__(self, key):
+        """Check whether there is a field with the name."""
+        return any(field.name == key for field in self.fields)
+
+    def __getitem__(self, key):
+        """Return the field with the name, or a list of fields if there are
+        multiple. KeyError is raised if there is no field with the name."""
+        fields = self._fields_named(key)
+        if not fields:
+            raise KeyError(key)
+        elif len(fields) == 1:
+            return fields[0]
+        else:
+            return fields
+
+    def close(self):
+        """Close the fields and remove the temporary files."""
+        for field in self.fields:
+            if field.file is not None:
+                field.file.close()
+            if field.temp_filepath is not None:
+                try:
+                    os.remove(field.temp_filepath)
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                field.temp_filepath = None
@@ -22,6 +22,18 @@ def sha1_hexdigest(input_string, size=20):
     return sha1.hexdigest()[0:size]
 
 
+def sha1_file_hexdigest(input_file, chunk_size=65536):
+    """Generate hexdigest(lower case, 40 digits) for the content of a file
+    object. The file is read in chunks of chunk_size bytes."""
+    sha1 = hashlib.sha1()
+    while True:
+        chunk = input_file.read(chunk_size)
+        if not chunk:
+            break
+        sha1.update(chunk)
+    return sha1.hexdigest()
+
+
 def unique_id(size=40):
     """Generate unique ID(as upper case hex string). size specifies the number
     of characters in the ID, which is 40 in maximum."""
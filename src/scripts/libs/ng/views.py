@@ -5,12 +5,117 @@ import errno
 import mimetypes
 import os
 import sys
+import zlib
+import str_generator
 from excepts import HttpError
 from excepts import FileLocateError
 from excepts import FileReadError
 from excepts import FileWriteError
 import _template_loader
 
+# Zero-copy file transfer of python 3 or the pysendfile package
+try:
+    from os import sendfile
+except ImportError:
+    try:
+        from sendfile import sendfile
+    except ImportError:
+        sendfile = None
+
+
+# Window bits of zlib streams for content codings of HTTP
+_ENCODING_WBITS = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS,
+}
+
+
+def content_encoder(encoding, level=6):
+    """Return a zlib compress object for the HTTP content coding."""
+    return zlib.compressobj(level, zlib.DEFLATED, _ENCODING_WBITS[encoding])
+
+
+def encode_content(content, encoding, level=6):
+    """Compress a string with the HTTP content coding."""
+    encoder = content_encoder(encoding, level)
+    return encoder.compress(content) + encoder.flush()
+
+
+class FileChunks(object):
+    """Iterable of fixed-size chunks of an open file. The file is closed
+    after all chunks are read or close() is called."""
+
+    chunk_size = 65536      # Size of chunks in bytes
+
+    def __init__(self, input_file):
+        """Create file chunks with an open file object."""
+        self.file = input_file
+        self.length = os.fstat(input_file.fileno()).st_size
+
+    def __iter__(self):
+        """Yield chunks of the file."""
+        try:
+            while True:
+                chunk = self.file.read(self.chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            self.close()
+
+    def fileno(self):
+        """Return the file descriptor of the file."""
+        return self.file.fileno()
+
+    def close(self):
+        """Close the file."""
+        self.file.close()
+
+
+class MemoryChunks(object):
+    """Iterable of fixed-size chunks of a string or a memory map."""
+
+    chunk_size = 65536      # Size of chunks in bytes
+
+    def __init__(self, content):
+        """Create memory chunks with a string or a memory map."""
+        self.content = content
+        self.length = len(content)
+
+    def __iter__(self):
+        """Yield chunks of the content."""
+        for offset in xrange(0, self.length, self.chunk_size):
+            yield self.content[offset:(offset + self.chunk_size)]
+
+
+class FileOffload(object):
+    """Setting that hands file transfers to the front-end web server. Views
+    with this setting only generate headers that tell the server which file
+    to send."""
+
+    X_SENDFILE = 'x-sendfile'               # Apache mod_xsendfile
+    X_ACCEL_REDIRECT = 'x-accel-redirect'   # Internal location of nginx
+
+    def __init__(self, mode, root_path=None, accel_prefix=None):
+        """Create file offload setting with mode. For X-Accel-Redirect mode,
+        files in root_path are mapped to URIs starting with accel_prefix."""
+        if mode not in (self.X_SENDFILE, self.X_ACCEL_REDIRECT):
+            raise ValueError('unknown file offload mode %s' % mode)
+
+        self.mode = mode
+        self.root_path = root_path
+        self.accel_prefix = accel_prefix
+
+    def headers(self, filepath):
+        """Return headers that let the front-end server send the file."""
+        if self.mode == self.X_SENDFILE:
+            return {'X-Sendfile': filepath}
+
+        relative_path = os.path.relpath(filepath, self.root_path)
+        uri = self.accel_prefix.rstrip('/') + '/' + \
+            relative_path.replace(os.sep, '/')
+        return {'X-Accel-Redirect': uri}
+
 
 class View(object):
     """Empty view."""
@@ -53,6 +158,57 @@ class View(object):
 
         return file_content
 
+    def _stream_with_file(self, filepath, text_mode):
+        """Render the body of this view as chunks of specified file.
+        text_mode should be True if the file is a text file."""
+        # Empty path means empty view
+        if not filepath:
+            return []
+
+        # Set file open mode
+        if text_mode:
+            open_mode = 'r'
+        else:
+            open_mode = 'rb'
+
+        # Try to open file, it is closed after streaming
+        try:
+            return FileChunks(open(filepath, open_mode))
+        except IOError as e:
+            # Raise different error according to error number of IOError
+            if e.errno == errno.ENOENT:
+                raise FileLocateError(filepath)
+            else:
+                raise FileReadError(filepath)
+
+    def _content_with_cached_file(self, filepath, blob_cache):
+        """Return content of specified file from blob_cache. None is returned
+        if the file is too large to cache or not admitted to the cache."""
+        try:
+            return blob_cache.get(filepath)
+        except (IOError, OSError) as e:
+            # Raise different error according to error number of the error
+            if e.errno == errno.ENOENT:
+                raise FileLocateError(filepath)
+            else:
+                raise FileReadError(filepath)
+
+    def _validators_with_file(self, filepath):
+        """Return the ETag and the last modified timestamp of a file."""
+        try:
+            stat = os.stat(filepath)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                raise FileLocateError(filepath)
+            else:
+                raise FileReadError(filepath)
+
+        # Different files of the same size may be modified at the same time
+        etag = '"%s-%x-%x"' % (str_generator.sha1_hexdigest(filepath, 8),
+                               int(stat.st_mtime),
+                               stat.st_size)
+        return etag, int(stat.st_mtime)
+
     def _render_with_text_file(self, filepath):
         """Render the body of this view with a text file."""
         return self._render_with_file(filepath, True)
@@ -65,14 +221,44 @@ class View(object):
         """Render the body of this view."""
         return ''
 
+    def _render_chunks(self):
+        """Render the body of this view as an iterable of strings."""
+        return [self._render_body()]
+
     def render_body(self):
         """Render and return the body of this view."""
         return self._render_body()
 
+    def render_chunks(self):
+        """Render and return the body of this view as an iterable of
+        strings."""
+        return self._render_chunks()
+
+    def validators(self):
+        """Return the ETag and the last modified timestamp of the body of
+        this view. None is returned for values that are not available."""
+        return None, None
+
+    def offload_headers(self):
+        """Return headers that let the front-end server send the body of
+        this view. Empty dictionary is returned if the body is rendered by
+        this view."""
+        return {}
+
+    def render_encoded(self, encoding, level=6, min_bytes=0):
+        """Return the body of this view compressed with the content coding
+        and level if it is kept compressed and has at least min_bytes bytes.
+        None is returned otherwise."""
+        return None
+
 
 class StaticView(View):
     """View that displays the content of a static html file."""
 
+    # Path -> (modified time, size, {(encoding, level): content}) of
+    # compressed files
+    _encoded_cache = {}
+
     def __init__(self, filepath):
         """Create a static view with path to the html file."""
         View.__init__(self, 'text/html')
@@ -82,12 +268,56 @@ class StaticView(View):
         """Render the body of this view with static html file."""
         return self._render_with_text_file(self.filepath)
 
+    def _render_chunks(self):
+        """Render the body of this view as chunks of static html file."""
+        return self._stream_with_file(self.filepath, True)
+
+    def render_encoded(self, encoding, level=6, min_bytes=0):
+        """Return content of the static html file compressed with the
+        content coding and level. The compressed content is kept in memory
+        until the file is modified. None is returned if the file has less
+        than min_bytes bytes or compressing doesn't make it smaller."""
+        if not self.filepath:
+            return None
+
+        try:
+            stat = os.stat(self.filepath)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                raise FileLocateError(self.filepath)
+            else:
+                raise FileReadError(self.filepath)
+
+        if stat.st_size < min_bytes:
+            return None
+
+        entry = StaticView._encoded_cache.get(self.filepath)
+        if entry is None or entry[:2] != (stat.st_mtime, stat.st_size):
+            entry = (stat.st_mtime, stat.st_size, {})
+            StaticView._encoded_cache[self.filepath] = entry
+
+        encoded_contents = entry[2]
+        key = (encoding, level)
+        if key not in encoded_contents:
+            content = self._render_body()
+            encoded_content = encode_content(content, encoding, level)
+            if len(encoded_content) >= len(content):
+                encoded_content = None
+            encoded_contents[key] = encoded_content
+
+        return encoded_contents[key]
+
 
 class ImageView(View):
     """View that displays an image."""
 
-    def __init__(self, image_path, image_format=None):
-        """Create an image view with path and format of the image file."""
+    def __init__(self, image_path, image_format=None, offload=None,
+                 blob_cache=None):
+        """Create an image view with path and format of the image file.
+        offload is the FileOffload setting if the front-end server should
+        send the file. blob_cache is the BlobCache that holds frequently used
+        images in memory, which is only used to stream the image if files
+        can't be sent with sendfile."""
         # Get image format from path if not given
         if not image_format:
             content_type, _ = mimetypes.guess_type(image_path)
@@ -96,23 +326,56 @@ class ImageView(View):
 
         View.__init__(self, content_type)
         self.filepath = image_path
+        self.offload = offload
+        self.blob_cache = blob_cache
 
     def _render_body(self):
         """Render the body of this view with image file."""
+        if self.blob_cache is not None:
+            content = self._content_with_cached_file(self.filepath,
+                                                     self.blob_cache)
+            if content is not None:
+                return content[:]
+
         return self._render_with_binary_file(self.filepath)
 
+    def _render_chunks(self):
+        """Render the body of this view as chunks of image file."""
+        # Sending the file without copying beats copying it from memory
+        if self.blob_cache is not None and sendfile is None:
+            content = self._content_with_cached_file(self.filepath,
+                                                     self.blob_cache)
+            if content is not None:
+                return MemoryChunks(content)
+
+        return self._stream_with_file(self.filepath, False)
+
+    def validators(self):
+        """Return the ETag and the last modified timestamp of the image."""
+        return self._validators_with_file(self.filepath)
+
+    def offload_headers(self):
+        """Return headers that let the front-end server send the image."""
+        if self.offload is None:
+            return {}
+
+        return self.offload.headers(self.filepath)
+
 
 class BinaryDataView(View):
     """View that send a binary file to client."""
 
-    def __init__(self, filepath, content_type=None):
-        """Create binary data view with file path and content type."""
+    def __init__(self, filepath, content_type=None, offload=None):
+        """Create binary data view with file path and content type. offload
+        is the FileOffload setting if the front-end server should send the
+        file."""
         # Guess content type if not given
         if not content_type:
             content_type = mimetypes.guess_type(filepath)
 
         View.__init__(self, content_type)
         self.filepath = filepath
+        self.offload = offload
 
         # Get Content-Disposition header from filename
         filename = os.path.basename(filepath)
@@ -122,6 +385,21 @@ class BinaryDataView(View):
         """Render the body of this view with binary file."""
         return self._render_with_binary_file(self.filepath)
 
+    def _render_chunks(self):
+        """Render the body of this view as chunks of binary file."""
+        return self._stream_with_file(self.filepath, False)
+
+    def validators(self):
+        """Return the ETag and the last modified timestamp of the file."""
+        return self._validators_with_file(self.filepath)
+
+    def offload_headers(self):
+        """Return headers that let the front-end server send the file."""
+        if self.offload is None:
+            return {}
+
+        return self.offload.headers(self.filepath)
+
 
 class TemplateFormatError(HttpError):
     """Error that is raised when a template contains illegal format."""
@@ -141,12 +419,15 @@ class TemplateFormatError(HttpError):
 class TemplateView(View):
     """View that displays html page loaded from a template."""
 
-    def __init__(self, template_filepath, template_arguments):
+    def __init__(self, template_filepath, template_arguments,
+                 streaming=False):
         """Create template view with path to template file
-        and arguments to evaluate template."""
+        and arguments to evaluate template. If streaming is True, the body
+        is rendered in chunks while it is being sent."""
         View.__init__(self, 'text/html')
         self.filepath = template_filepath
         self.template_arguments = template_arguments
+        self.streaming = streaming
 
     def _render_body(self):
         """Render the body of this view with template file and arguments."""
@@ -162,3 +443,29 @@ class TemplateView(View):
             raise TemplateFormatError(self.filepath, e)
         except _template_loader.TemplateEvalError as e:
             raise TemplateFormatError(self.filepath, e)
+
+    def _render_chunks(self):
+        """Render the body of this view as chunks of html that are evaluated
+        part by part if streaming is enabled."""
+        if not self.streaming:
+            return View._render_chunks(self)
+
+        try:
+            chunks = _template_loader.iter_template(
+                self.filepath,
+                self.template_arguments
+            )
+        except _template_loader.TemplateSplitError as e:
+            raise TemplateFormatError(self.filepath, e)
+        except _template_loader.TemplateEvalError as e:
+            raise TemplateFormatError(self.filepath, e)
+
+        return self._stream_chunks(chunks)
+
+    def _stream_chunks(self, chunks):
+        """Yield chunks of html while converting errors of evaluation."""
+        try:
+            for chunk in chunks:
+                yield chunk
+        except _template_loader.TemplateEvalError as e:
+            raise TemplateFormatError(self.filepath, e)
@@ -26,12 +26,41 @@ CREATE TABLE `avatar` (
   `file_path` varchar(255) NOT NULL COMMENT 'path to the file',
   `add_time` varchar(45) NOT NULL COMMENT 'time of adding this avatar',
   PRIMARY KEY (`aid`),
-  UNIQUE KEY `file_path_UNIQUE` (`file_path`),
+  KEY `file_path_idx` (`file_path`),
   KEY `fk_avatar_owner_uid_idx` (`owner_uid`),
   CONSTRAINT `fk_avatar_owner_uid` FOREIGN KEY (`owner_uid`) REFERENCES `account` (`uid`) ON DELETE CASCADE ON UPDATE NO ACTION
 ) ENGINE=InnoDB AUTO_INCREMENT=12 DEFAULT CHARSET=utf8;
 
 
+-- Create avatar blob table
+CREATE TABLE `avatar_blob` (
+  `file_path` varchar(255) NOT NULL COMMENT 'path to the file shared by avatars',
+  `content_hash` char(40) DEFAULT NULL COMMENT 'sha1 hash of the file content',
+  `ref_count` int(10) unsigned NOT NULL DEFAULT '0' COMMENT 'number of avatars that use this file',
+  PRIMARY KEY (`file_path`),
+  UNIQUE KEY `content_hash_UNIQUE` (`content_hash`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
+
+-- Create avatar variant table
+CREATE TABLE `avatar_variant` (
+  `file_path` varchar(255) NOT NULL COMMENT 'path to the resized avatar image',
+  `size_bytes` int(10) unsigned NOT NULL COMMENT 'size of the image file',
+  `access_time` datetime NOT NULL COMMENT 'time of serving the image lately',
+  PRIMARY KEY (`file_path`),
+  KEY `access_time_idx` (`access_time`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
+
+-- Create avatar variant usage table, which has a single row
+CREATE TABLE `avatar_variant_usage` (
+  `id` tinyint(4) unsigned NOT NULL COMMENT 'id of the row, which is always 1',
+  `total_bytes` bigint(20) NOT NULL DEFAULT '0' COMMENT 'total size of resized avatar images',
+  PRIMARY KEY (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+INSERT INTO `avatar_variant_usage` VALUES (1, 0);
+
+
 -- Create email table
 CREATE TABLE `email` (
   `emid` bigint(20) unsigned NOT NULL AUTO_INCREMENT COMMENT 'id of email',
@@ -57,6 +86,8 @@ CREATE TABLE `session` (
   `data` text NOT NULL COMMENT 'data of the session',
   `expire_time` datetime NOT NULL COMMENT 'expiring time of this session',
   `creator_ip` varchar(45) NOT NULL COMMENT 'ip of the client that creates this session',
+  `uid` bigint(20) unsigned DEFAULT NULL COMMENT 'id of the account signed in with this session',
   PRIMARY KEY (`sid`),
-  UNIQUE KEY `session_key_UNIQUE` (`session_key`)
+  UNIQUE KEY `session_key_UNIQUE` (`session_key`),
+  KEY `uid_idx` (`uid`)
 ) ENGINE=InnoDB AUTO_INCREMENT=58 DEFAULT CHARSET=utf8;
@@ -0,0 +1,23 @@
+-- Share avatar image files with the same content between avatars
+USE `ngavatar`;
+
+
+-- Allow avatars to use the same file
+ALTER TABLE `avatar`
+  DROP INDEX `file_path_UNIQUE`,
+  ADD KEY `file_path_idx` (`file_path`);
+
+
+-- Create avatar blob table
+CREATE TABLE `avatar_blob` (
+  `file_path` varchar(255) NOT NULL COMMENT 'path to the file shared by avatars',
+  `content_hash` char(40) DEFAULT NULL COMMENT 'sha1 hash of the file content',
+  `ref_count` int(10) unsigned NOT NULL DEFAULT '0' COMMENT 'number of avatars that use this file',
+  PRIMARY KEY (`file_path`),
+  UNIQUE KEY `content_hash_UNIQUE` (`content_hash`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
+
+-- Existing files are used by one avatar each and are not deduplicated
+INSERT INTO `avatar_blob` (`file_path`, `ref_count`)
+  SELECT `file_path`, COUNT(*) FROM `avatar` GROUP BY `file_path`;
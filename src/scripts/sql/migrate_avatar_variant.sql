@@ -0,0 +1,26 @@
+-- Record resized avatar images to enforce their byte budget without
+-- scanning the storage
+USE `ngavatar`;
+
+
+-- Create avatar variant table
+CREATE TABLE `avatar_variant` (
+  `file_path` varchar(255) NOT NULL COMMENT 'path to the resized avatar image',
+  `size_bytes` int(10) unsigned NOT NULL COMMENT 'size of the image file',
+  `access_time` datetime NOT NULL COMMENT 'time of serving the image lately',
+  PRIMARY KEY (`file_path`),
+  KEY `access_time_idx` (`access_time`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
+
+-- Create avatar variant usage table, which has a single row
+CREATE TABLE `avatar_variant_usage` (
+  `id` tinyint(4) unsigned NOT NULL COMMENT 'id of the row, which is always 1',
+  `total_bytes` bigint(20) NOT NULL DEFAULT '0' COMMENT 'total size of resized avatar images',
+  PRIMARY KEY (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+INSERT INTO `avatar_variant_usage` VALUES (1, 0);
+
+
+-- Existing resized images are recorded with their sizes when they are
+-- served again, and images that are never served again are not counted
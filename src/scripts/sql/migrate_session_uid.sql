@@ -0,0 +1,9 @@
+-- Link sessions to the accounts signed in with them
+USE `ngavatar`;
+
+
+-- Sessions created before this column keep NULL and load their accounts
+-- with another query until they expire
+ALTER TABLE `session`
+  ADD COLUMN `uid` bigint(20) unsigned DEFAULT NULL COMMENT 'id of the account signed in with this session',
+  ADD KEY `uid_idx` (`uid`);
@@ -108,6 +108,15 @@ echo "$root_dir/scripts/libs" > /usr/local/lib/python2.7/dist-packages/ngavatar.
 echo "Customizing configuration file..."
 sed -i -e "s/DOC_ROOT/$root_dir_t/g" -e "s/MYSQL_HOST/$mysql_host/g" -e "s/MYSQL_PORT/$mysql_port/g" $root_dir/scripts/conf/ngavatar.conf || exit 5
 
+# Compile templates, which also checks whether they are malformed
+echo "Compiling templates..."
+python $root_dir/scripts/cgi/compile_templates.py || exit 9
+
+# Let the apache2 user update compiled templates written as root
+web_user=$(. /etc/apache2/envvars 2>/dev/null && echo $APACHE_RUN_USER)
+web_user=${web_user:-www-data}
+chown -R "$web_user:" $root_dir/template_cache || exit 9
+
 # Initialize database
 echo "Initializing MySQL database..."
 mysql -h $mysql_host -P $mysql_port -u root --password="$mysql_passwd" <../src/scripts/sql/create_database.sql || exit 6